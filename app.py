@@ -1,10 +1,435 @@
 import util
 
+import asyncio
 import socket
+import threading
+import zlib
 
 class ConnectionError(Exception):
     pass
 
+class FrameReader:
+    """Read complete messages from a socket, one at a time.
+
+    Received bytes go straight into a reusable buffer (using recv_into), and a message is
+    copied out of it exactly once. Bytes received past the end of a message are kept for the
+    next call. The buffer grows to fit large messages and shrinks back once the traffic
+    returns to small messages.
+    """
+
+    def __init__(self, sock: socket.socket, framing='text', buffer_size=4096, max_frame_size=64 * 1024 * 1024):
+        """
+        Parameters
+        ----------
+        sock : socket.socket
+        framing : str
+            The framing mode of the connection, 'text' or 'binary'. Can be changed later, e.g.
+            after the connect handshake.
+        buffer_size : int
+            Initial (and minimum) size of the buffer
+        max_frame_size : int
+            Messages larger than this are rejected
+        """
+
+        self.sock = sock
+        self.framing = framing
+        self.min_buffer_size = buffer_size
+        self.max_frame_size = max_frame_size
+
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+
+        # Received but not yet returned data is in buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+        # Number of consecutive messages much smaller than the buffer
+        self.small_frames = 0
+
+        # Whether the text messages are sized by an older client (see util.legacy_message_length).
+        # Set during the connect handshake.
+        self.legacy_sizes = False
+
+    def pending(self) -> bytes:
+        """Bytes received after the last returned message
+        """
+
+        return bytes(self.view[self.start:self.end])
+
+    def frame_length(self) -> int:
+        """Length of the message at the start of the pending data, -1 if not known yet
+
+        Raises
+        ------
+        ConnectionError
+            If the message is malformed or larger than max_frame_size.
+        """
+
+        try:
+            if self.framing == 'binary':
+                size = util.frame_length(self.buffer, self.start, self.end)
+            else:
+                size = util.message_length(self.buffer, self.start, self.end)
+                if size == -1 and self.end - self.start > self.min_buffer_size:
+                    raise ValueError('Header too long')
+                if size != -1 and self.legacy_sizes:
+                    size = util.legacy_message_length(size)
+        except ValueError:
+            raise ConnectionError('Invalid message')
+
+        if size > self.max_frame_size:
+            raise ConnectionError('Message too large')
+        return size
+
+    def resize(self, capacity):
+        """Move the pending data to the start of a new buffer with the given capacity
+        """
+
+        pending = self.end - self.start
+        buffer = bytearray(capacity)
+        buffer[:pending] = self.view[self.start:self.end]
+
+        self.view.release()
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.start, self.end = 0, pending
+
+    def make_room(self, size):
+        """Make sure the buffer can hold the whole message of the given size (or at least a few
+        more bytes if the size is unknown)
+        """
+
+        needed = max(size, self.end - self.start + self.min_buffer_size // 4)
+        if needed > len(self.buffer):
+            # Grow geometrically so that a large message is received with O(n) copying
+            capacity = len(self.buffer)
+            while capacity < needed:
+                capacity *= 2
+            self.resize(capacity)
+        elif self.start + needed > len(self.buffer):
+            # Enough space, but the pending data must be moved to the front
+            self.resize(len(self.buffer))
+
+    def read(self) -> bytes:
+        """Block until a full message is received
+
+        Returns
+        -------
+        bytes
+            The full message
+
+        Raises
+        ------
+        ConnectionError
+            If the connection is closed or the message is invalid.
+        """
+
+        size = self.frame_length()
+        while size == -1 or self.end - self.start < size:
+            self.make_room(size)
+            n = self.sock.recv_into(self.view[self.end:])
+            if n == 0:
+                raise ConnectionError('Connection closed')
+            self.end += n
+            if size == -1:
+                size = self.frame_length()
+        return self.take(size)
+
+    def fill(self):
+        """Receive the bytes available on the socket, with a single call. Meant for sockets known
+        to be readable (e.g. by a selector), on which it does not block.
+
+        Raises
+        ------
+        ConnectionError
+            If the connection is closed or the message is invalid.
+        """
+
+        self.make_room(self.frame_length())
+        try:
+            n = self.sock.recv_into(self.view[self.end:])
+        except OSError:
+            raise ConnectionError('Connection closed')
+        if n == 0:
+            raise ConnectionError('Connection closed')
+        self.end += n
+
+    def next_frame(self):
+        """Take the message at the start of the pending data, without receiving anything
+
+        Returns
+        -------
+        bytes
+            The full message, None if it is not completely received yet.
+        """
+
+        size = self.frame_length()
+        if size == -1 or self.end - self.start < size:
+            return None
+        return self.take(size)
+
+    def take(self, size) -> bytes:
+        """Remove the complete message of the given size from the start of the pending data
+
+        Returns
+        -------
+        bytes
+        """
+
+        frame = bytes(self.view[self.start:self.start + size])
+        self.start += size
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        # Shrink the buffer back after a run of small messages
+        if size * 4 < len(self.buffer) and len(self.buffer) > self.min_buffer_size:
+            self.small_frames += 1
+            if self.small_frames >= 16 and self.end - self.start <= len(self.buffer) // 2:
+                self.resize(max(len(self.buffer) // 2, self.min_buffer_size))
+                self.small_frames = 0
+        else:
+            self.small_frames = 0
+        return frame
+
+
+class Connection:
+    """A connection to the other side, together with the protocol features negotiated during the
+    connect handshake
+    """
+
+    def __init__(self, sock: socket.socket, reader: FrameReader, features=None):
+        """
+        Parameters
+        ----------
+        sock : socket.socket
+        reader : FrameReader
+            The frame reader of sock, holding the framing mode
+        features : dict
+            The features accepted during the connect handshake (see util.parse_features)
+        """
+
+        self.sock = sock
+        self.reader = reader
+        self.features = features if features is not None else {}
+
+        # Compression contexts (util.Compression), None if compression is disabled
+        self.compression = None
+
+        # Largest message the peer accepts, None if unknown
+        self.max_frame_size = None
+
+        # Messages may be sent from several threads (pipelining), and compressed messages must
+        # be sent in the order they were compressed
+        self.send_lock = threading.Lock()
+
+    @property
+    def framing(self):
+        return self.reader.framing
+
+    def send(self, field1, field2, data, request_id=None, flags=0):
+        """Send a message
+
+        Parameters
+        ----------
+        field1 : str
+        field2 : str
+        data : str
+        request_id : int
+            Optional request ID (binary framing only)
+        flags : int
+            Additional frame flags (binary framing only)
+
+        Raises
+        ------
+        ConnectionError
+            If the connection is closed, or the message is larger than the peer accepts.
+        """
+
+        try:
+            with self.send_lock:
+                m = util.package_as(self.framing, field1, field2, data, request_id, self.compression, flags)
+                self.check_size(m)
+                self.transmit(m)
+        except OSError:
+            raise ConnectionError('Connection closed')
+
+    def send_many(self, messages):
+        """Send several messages at once
+
+        Parameters
+        ----------
+        messages : list
+            A list of (field1, field2, data, request_id).
+
+        Raises
+        ------
+        ConnectionError
+        """
+
+        try:
+            with self.send_lock:
+                packaged = [util.package_as(self.framing, *m, self.compression) for m in messages]
+                for m in packaged:
+                    self.check_size(m)
+                self.transmit(b''.join(packaged))
+        except OSError:
+            raise ConnectionError('Connection closed')
+
+    def transmit(self, data: bytes):
+        """Write already packaged messages to the socket (called with send_lock held)
+        """
+
+        self.sock.sendall(data)
+
+    def abort(self):
+        """Close the connection in both directions, without waiting for pending data
+        """
+
+        self.sock.shutdown(socket.SHUT_RDWR)
+
+    def close(self):
+        """End the stream sent to the peer, once the messages already sent are delivered. The
+        connection is still read until the peer closes its side, so that it is not reset with
+        these messages in flight.
+        """
+
+        # Sent messages are in the kernel's buffer, and go out before the end of the stream
+        self.sock.shutdown(socket.SHUT_WR)
+
+    def check_size(self, message: bytes):
+        """Make sure the peer accepts a message before sending it
+
+        Raises
+        ------
+        ConnectionError
+            If the message is larger than max_frame_size.
+        """
+
+        if self.max_frame_size is not None and len(message) > self.max_frame_size:
+            # The message may already have gone through the compression context, so the
+            # connection cannot be used anymore
+            self.abort()
+            raise ConnectionError('Message too large')
+
+    def receive(self) -> tuple:
+        """Block until a full message is received
+
+        Returns
+        -------
+        tuple
+            A tuple of (field1, field2, data, request_id, flags), request_id being None if the message
+            does not carry one, and flags being the frame flags (0 in text framing).
+
+        Raises
+        ------
+        ConnectionError
+        """
+
+        return self.parse(self.reader.read())
+
+    def parse(self, m: bytes) -> tuple:
+        """Extract the fields of a received message (see receive)
+        """
+
+        try:
+            field1, field2, _, data = util.extract_as(self.framing, m, self.compression)
+        except (ValueError, KeyError, UnicodeDecodeError, zlib.error):
+            raise ConnectionError('Invalid message')
+        if self.framing == 'binary':
+            return field1, field2, data, util.frame_request_id(m), util.frame_flags(m)
+        return field1, field2, data, None, 0
+
+
+class AsyncFrameReader(FrameReader):
+    """Same as FrameReader, reading from an asyncio stream instead of a socket
+    """
+
+    def __init__(self, stream: asyncio.StreamReader, framing='text', buffer_size=4096, max_frame_size=64 * 1024 * 1024):
+        super().__init__(stream, framing, buffer_size, max_frame_size)
+
+    async def read(self) -> bytes:
+        """Wait until a full message is received
+
+        Returns
+        -------
+        bytes
+            The full message
+
+        Raises
+        ------
+        ConnectionError
+            If the connection is closed or the message is invalid.
+        """
+
+        size = self.frame_length()
+        while size == -1 or self.end - self.start < size:
+            self.make_room(size)
+            try:
+                data = await self.sock.read(len(self.buffer) - self.end)
+            except OSError:
+                raise ConnectionError('Connection closed')
+            if not data:
+                raise ConnectionError('Connection closed')
+            self.view[self.end:self.end + len(data)] = data
+            self.end += len(data)
+            if size == -1:
+                size = self.frame_length()
+        return self.take(size)
+
+
+class AsyncConnection(Connection):
+    """A connection served by an asyncio event loop. Messages are received by the event loop
+    (receive is a coroutine), and sent from any thread: from other threads, send and send_many
+    block until the data is handed to the transport. From the event loop thread, the data is
+    buffered by the transport without waiting.
+    """
+
+    def __init__(self, reader: AsyncFrameReader, writer: asyncio.StreamWriter, features=None):
+        """
+        Parameters
+        ----------
+        reader : AsyncFrameReader
+
+        writer : asyncio.StreamWriter
+
+        features : dict
+            The features accepted during the connect handshake (see util.parse_features)
+        """
+
+        super().__init__(writer.get_extra_info('socket'), reader, features)
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+
+    async def receive(self) -> tuple:
+        """Wait until a full message is received (see Connection.receive)
+        """
+
+        return self.parse(await self.reader.read())
+
+    async def write(self, data: bytes):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def transmit(self, data: bytes):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            # Waiting for the loop from its own thread would never end
+            self.writer.write(data)
+            return
+
+        # Waiting for the write to complete applies the transport's flow control to the sender
+        asyncio.run_coroutine_threadsafe(self.write(data), self.loop).result()
+
+    def abort(self):
+        self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.writer.write_eof)
+
+
 class App:
     """Base class for Client and Server class
     """
@@ -15,58 +440,53 @@ class App:
         self.main_socket = None
         self.socket_buffer = 1024
 
+        # Messages larger than this are rejected by the frame readers
+        self.MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+        # The connection established on main_socket (used by clients)
+        self.connection = None
+
         # Ports
         self.DISCOVERY_PORT = 2410
         self.SERVER_PORT = 2802
 
-    def receive_from(self, s: socket.socket) -> bytes:
-        """Receive data from a given socket
+    def create_reader(self, s: socket.socket, framing='text') -> FrameReader:
+        """Create a frame reader for a given socket
 
         Parameters
         ----------
         s : socket.socket
+        framing : str
 
         Returns
         -------
-        bytes
-            The full message
+        FrameReader
         """
 
-        # Receive the first message
-        message = s.recv(self.socket_buffer)
-        if len(message) == 0:
-            raise ConnectionError('Connection closed')
-
-        # Investigate the size
-        _, _, size, _ = util.extract(message)
+        return FrameReader(s, framing, max_frame_size=self.MAX_FRAME_SIZE)
 
-        # The number of remaining parts of the message to receive
-        r = size // self.socket_buffer - 1
-
-        # Receive the rest
-        while r >= 0:
-            message += s.recv(self.socket_buffer)
-            r -= 1
-        return message
-
-    def send(self, message: bytes):
+    def send(self, field1, field2, data, request_id=None, flags=0):
         """Send message using main_socket
 
         Parameters
         ----------
-        message : bytes
+        field1 : str
+        field2 : str
+        data : str
+        request_id : int
+        flags : int
 
         """
         
-        self.main_socket.send(message)
+        self.connection.send(field1, field2, data, request_id, flags)
 
-    def receive(self) -> bytes:
+    def receive(self) -> tuple:
         """Receive from the main_socket
 
         Returns
         -------
-        bytes
-            The full message
+        tuple
+            A tuple of (field1, field2, data, request_id, flags)
         """
 
-        return self.receive_from(self.main_socket)
+        return self.connection.receive()
@@ -1,4 +1,5 @@
 import datetime
+import itertools
 import socket
 import tkinter as tk
 from tkinter import messagebox
@@ -40,20 +41,62 @@ class Client(app.App):
         self.username = ''
         self.name = ''
 
+        # Token of the session started at login, used to log in again after reconnecting
+        self.session_token = None
+
+        # Address of the server, to reconnect to
+        self.server_address = None
+
+        # Preset compression dictionary obtained from the server, used on the next connections
+        self.compression_dictionary = None
+
         # tkinter's events
         self.BUTTON_1 = '<Button-1>'
         self.RETURN = '<Return>'
         self.COMBOBOX_SELECTED = '<<ComboboxSelected>>'
 
+        # City search results are loaded one page at a time
+        self.SEARCH_PAGE_SIZE = 50
+        self.MORE_RESULTS = '(More results)'
+
+        # Interval between pings keeping the connection open (in milliseconds), well below the
+        # server's idle timeout
+        self.KEEPALIVE_INTERVAL = 60 * 1000
+
+        # Maximum number of sub-requests of a batch accepted by the server: larger batches are
+        # sent in several parts
+        self.MAX_BATCH_SIZE = 40
+
         # Create all the windows and widgets
         self.create_gui()
         self.root.report_callback_exception = self.report_callback_exception
+        self.root.after(self.KEEPALIVE_INTERVAL, self.keep_alive)
 
     # ---------- Utility methods ---------
 
     def report_callback_exception(self, exc, val, tb):
+        if isinstance(val, app.ConnectionError) and self.session_token is not None:
+            # The connection dropped: reconnect and resume the session instead of logging in again
+            try:
+                if self.resume() is None:
+                    messagebox.showinfo('Reconnected', 'The connection to the server was lost and has been restored. Please try again.')
+                    return
+            except app.ConnectionError:
+                pass
         messagebox.showerror('Error', val)
 
+    def keep_alive(self):
+        """Ping the server regularly, so that it does not close the connection for being idle
+        """
+
+        if self.connection is not None:
+            try:
+                self.ping()
+            except app.ConnectionError:
+                # Noticed by the next request
+                pass
+        self.root.after(self.KEEPALIVE_INTERVAL, self.keep_alive)
+
 
     # ---------- GUI definition methods ------------
 
@@ -380,19 +423,20 @@ class Client(app.App):
         temp = datetime.datetime.strptime(date, '%d-%m-%Y')
         day_iso = datetime.date(temp.year, temp.month, temp.day).isoformat()
 
-        # Contact the server
-        result = self.query_weather_by_date(day_iso)
-        if type(result) is tuple:
-            raise ClientError(f'{result[1]}.\nError code: {result[0]}')
-        else:
-            self.f_weather.t_weather.remove_all()
-            numcity, cities = result.split('\n', 1)
-            if numcity == '0':
-                self.f_weather.t_weather.add_row(('No data',))
-            else:
-                for city in cities.splitlines():
-                    _, city_name, country, _, weather_description, min_degree, max_degree, precipitation = city.split(',')
-                    self.f_weather.t_weather.add_row((city_name, country, weather_description, min_degree, max_degree, precipitation))
+        # Contact the server, and display the rows as they arrive
+        self.f_weather.t_weather.remove_all()
+        numcity = 0
+        for cities in self.query_weather_by_date_stream(day_iso):
+            for city in cities:
+                _, city_name, country, _, weather_description, min_degree, max_degree, precipitation = city
+                self.f_weather.t_weather.add_row(
+                    tuple(str(x) for x in (city_name, country, weather_description, min_degree, max_degree, precipitation))
+                )
+            numcity += len(cities)
+            self.root.update_idletasks()
+
+        if numcity == 0:
+            self.f_weather.t_weather.add_row(('No data',))
 
     def command_fforecast_csearchbar_onreturn(self, event):
         """Actions taken when hitting return in the Search combobox in the Forecast frame
@@ -407,17 +451,31 @@ class Client(app.App):
         if len(kw) < 3:
             return
         
-        result = self.search_city(kw)
+        self.f_forecast.recent_cities.clear()
+        self.f_forecast.recent_cities = {}
+        self.load_search_page(kw, None)
+
+    def load_search_page(self, kw, token):
+        """Search cities one page at a time, and add the results to the Search combobox (with a
+        "More results" option if there is a next page)
+
+        Parameters
+        ----------
+        kw : str
+            The keyword
+        token : str
+            The continuation token of the page, None for the first page
+        """
+
+        result = self.search_city(kw, self.SEARCH_PAGE_SIZE, token)
         if type(result) is tuple:
             self.f_forecast.c_searchbar['values'] = ['(No result)']
         else:
-            numcity, cities = result.split('\n', 1)
-            if numcity == '0':
+            header, cities = result.split('\n', 1)
+            numcity, _, token = header.partition(',')
+            if numcity == '0' and len(self.f_forecast.recent_cities) == 0:
                 self.f_forecast.c_searchbar['values'] = ['(No result)']
             else:
-                self.f_forecast.recent_cities.clear()
-                self.f_forecast.recent_cities = {}
-
                 for city in cities.splitlines():
                     city_id, city_name, country_name = city.split(',', 2)
                     # Value to be put in the combobox
@@ -426,7 +484,11 @@ class Client(app.App):
                         v += ' *'
                     self.f_forecast.recent_cities[v] = city_id
 
-                self.f_forecast.c_searchbar['values'] = list(self.f_forecast.recent_cities.keys())
+                values = list(self.f_forecast.recent_cities.keys())
+                if token:
+                    values.append(self.MORE_RESULTS)
+                self.f_forecast.search_page = (kw, token)
+                self.f_forecast.c_searchbar['values'] = values
             self.f_forecast.c_searchbar.event_generate(self.BUTTON_1)
 
     def command_fforecast_csearchbar_onselect(self, event):
@@ -440,6 +502,10 @@ class Client(app.App):
         """
 
         city = self.f_forecast.c_searchbar.get()
+        if city == self.MORE_RESULTS:
+            self.f_forecast.c_searchbar.set('')
+            self.load_search_page(*self.f_forecast.search_page)
+            return
         city_id = self.f_forecast.recent_cities[city]
 
         result = self.forecast(city_id)
@@ -479,12 +545,57 @@ class Client(app.App):
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.settimeout(5.0)
             s.connect((server_address, self.SERVER_PORT))
-
-            s.send(util.package('connect', '', ''))
-            status_code, status_message, _, _ = util.extract(self.receive_from(s))
+            self.server_address = server_address
+
+            # Ask for the binary framing, pipelining and compression. The server answers with the
+            # features it accepted, old servers answer with an empty data field (text framing only).
+            requested = {
+                'version': str(util.PROTOCOL_VERSION),
+                'maxframe': str(self.MAX_FRAME_SIZE),
+                'binary': '', 'pipeline': '', 'zlib': '', 'zdict': '', 'stream': '', 'binrows': '',
+                'session': '',
+            }
+            if self.compression_dictionary:
+                requested['zdict'] = util.dictionary_id(self.compression_dictionary)
+            s.sendall(util.package('connect', '', util.format_features(requested)))
+
+            reader = self.create_reader(s)
+            status_code, status_message, _, features = util.extract(reader.read())
             if status_code != '000':
                 s.close()
+                # Servers rejecting the client when full tell when to try again
+                if status_code == '001' and features.isdigit():
+                    status_message = f'{status_message}. Try again in {features} seconds'
                 raise app.ConnectionError(status_message)
+
+            # Only keep the features both sides know about
+            accepted = {k: v for k, v in util.parse_features(features).items() if k in requested}
+            reader.framing = 'binary' if 'binary' in accepted else 'text'
+            self.connection = app.Connection(s, reader, accepted)
+            if 'maxframe' in accepted:
+                self.connection.max_frame_size = min(int(accepted['maxframe']), self.MAX_FRAME_SIZE)
+
+            if 'zlib' in accepted:
+                # The preset dictionary is used only if both sides hold the same one
+                server_dictionary = accepted.get('zdict', '')
+                use_dictionary = server_dictionary != '' and server_dictionary == requested['zdict']
+                self.connection.compression = util.Compression(
+                    dictionary=self.compression_dictionary if use_dictionary else None,
+                    max_size=reader.max_frame_size
+                )
+
+            # Pipelining state: the next request ID, and the responses received but not yet claimed
+            self.request_ids = itertools.count(1)
+            self.responses = {}
+
+            # Chunks of the streamed responses being received, by request ID
+            self.chunks = {}
+
+            # Get the server's dictionary for the next connections
+            if 'zlib' in accepted and accepted.get('zdict', '') not in ('', requested['zdict']):
+                status_code, _, dictionary = self.request('query', 'dictionary', '')
+                if status_code == '000':
+                    self.compression_dictionary = dictionary.encode()
             return s
         except ConnectionRefusedError:
             s.close()
@@ -554,12 +665,171 @@ class Client(app.App):
 
     def test(self):
         data = ''
-        self.send(util.package('test', '', data))
-        m = self.receive()
-        status_code, status_message, size, data = util.extract(m)
-        print(size)
+        self.send('test', '', data)
+        status_code, status_message, data, _ = self.receive_response()
         print(len(data))
 
+    def receive(self) -> tuple:
+        """Receive from the main_socket (see app.App.receive)
+
+        Raises
+        ------
+        app.ConnectionError
+            If the connection is closed, including by the server going away.
+        """
+
+        message = super().receive()
+        if message[0] == 'goaway':
+            # The server is shutting down, and closes the connection once it is idle
+            self.connection.sock.close()
+            raise app.ConnectionError('The server is shutting down.')
+        return message
+
+    def request(self, command, command_type, data):
+        """Send a request to the server and wait for its response
+
+        Parameters
+        ----------
+        command : str
+
+        command_type : str
+
+        data : str
+
+
+        Returns
+        -------
+        tuple
+            A tuple of (status_code, status_message, data).
+        """
+
+        if 'pipeline' in self.connection.features:
+            return self.request_many([(command, command_type, data)])[0]
+
+        self.send(command, command_type, data)
+        status_code, status_message, data, _ = self.receive_response()
+        return status_code, status_message, data
+
+    def receive_response(self):
+        """Receive the next complete response, reassembling the chunks of streamed responses
+        (in the same format as a non-streamed response)
+
+        Returns
+        -------
+        tuple
+            A tuple of (status_code, status_message, data, request_id).
+        """
+
+        while True:
+            status_code, status_message, data, request_id, flags = self.receive()
+            if flags & util.FLAG_MORE:
+                self.chunks.setdefault(request_id, []).append(data)
+                continue
+
+            if request_id in self.chunks:
+                # Terminator of a streamed response, data is the number of rows
+                rows = ''.join(self.chunks.pop(request_id))
+                if status_code == '000':
+                    data = data + '\n' + rows
+            if status_code == '003':
+                # Rate limited, data is the number of seconds to wait
+                status_message = f'{status_message}. Try again in {data} seconds'
+            return status_code, status_message, data, request_id
+
+    def request_stream(self, command, command_type, data):
+        """Send a request whose response is made of rows, and yield the rows as they arrive
+        (if the server streams its responses, otherwise all of them at once)
+
+        Parameters
+        ----------
+        command : str
+
+        command_type : str
+
+        data : str
+
+
+        Yields
+        ------
+        list
+            A list of tuples, one for each row. Values are strings when the rows are received in
+            text, and typed (int, float, None) when they are received in binary.
+
+        Raises
+        ------
+        ClientError
+            If the request fails.
+        """
+
+        binary = 'binrows' in self.connection.features
+        self.send(command, command_type, data, flags=util.FLAG_BINARY_ROWS if binary else 0)
+        while True:
+            status_code, status_message, data, _, flags = self.receive()
+            if status_code != '000':
+                raise ClientError(f'{status_message}.\nError code: {status_code}')
+            if flags & util.FLAG_MORE:
+                yield self.parse_rows(data, flags)
+                continue
+
+            if 'stream' not in self.connection.features:
+                # The whole result, after the line containing the number of rows
+                sep = b'\n' if flags & util.FLAG_BINARY_ROWS else '\n'
+                yield self.parse_rows(data.split(sep, 1)[1], flags)
+            return
+
+    def parse_rows(self, data, flags):
+        """Parse the rows of a response, in text or in binary depending on the flags of the frame
+
+        Parameters
+        ----------
+        data : str or bytes
+
+        flags : int
+
+
+        Returns
+        -------
+        list
+            A list of tuples.
+        """
+
+        if flags & util.FLAG_BINARY_ROWS:
+            return util.decode_rows(data)
+        return [tuple(line.split(',')) for line in data.splitlines()]
+
+    def request_many(self, requests):
+        """Send several requests at once and wait for all the responses. If the server supports
+        pipelining, all the requests are sent back to back, which costs about one round trip in total.
+
+        Parameters
+        ----------
+        requests : list
+            A list of (command, command_type, data).
+
+        Returns
+        -------
+        list
+            A list of (status_code, status_message, data), in the same order as requests.
+        """
+
+        if 'pipeline' not in self.connection.features:
+            return [self.request(*r) for r in requests]
+
+        request_ids = []
+        messages = []
+        for command, command_type, data in requests:
+            request_id = next(self.request_ids) % 2 ** 32
+            request_ids.append(request_id)
+            messages.append((command, command_type, data, request_id))
+        self.connection.send_many(messages)
+
+        # Responses may arrive in any order
+        for request_id in request_ids:
+            while request_id not in self.responses:
+                status_code, status_message, data, response_id = self.receive_response()
+                self.responses[response_id] = (status_code, status_message, data)
+        return [self.responses.pop(request_id) for request_id in request_ids]
+
     def log_in(self, username, password):
         """Log in with the given (already checked) username and password
 
@@ -578,12 +848,7 @@ class Client(app.App):
             A formatted string of {username},{name} on success.
         """
 
-        self.send(util.package('login', '', f'{username},{password}'))
-        status_code, status_message, _, data = util.extract(self.receive())
-        if status_code == '000':
-            return data
-        else:
-            return status_code, status_message
+        return self.request_login('', username, password)
     
     def log_in_as_admin(self, username, password):
         """Log in as admin with the given (already checked) username and password
@@ -603,13 +868,63 @@ class Client(app.App):
             A formatted string of {username},{name} on success.
         """
 
-        self.send(util.package('login', 'admin', f'{username},{password}'))
-        status_code, status_message, _, data = util.extract(self.receive())
-        if status_code == '000':
-            return data
-        else:
+        return self.request_login('admin', username, password)
+
+    def request_login(self, login_type, username, password):
+        """Send a login request, asking for a session token if the server supports sessions
+
+        Parameters
+        ----------
+        login_type : str
+            '' or 'admin'
+        username : str
+
+        password : str
+
+
+        Returns
+        -------
+        tuple
+            A tuple of (status_code, status_message) on failure.
+        str
+            A formatted string of {username},{name} on success.
+        """
+
+        data = f'{username},{password}'
+        if 'session' in self.connection.features:
+            data += '\nsession'
+
+        status_code, status_message, data = self.request('login', login_type, data)
+        if status_code != '000':
             return status_code, status_message
 
+        data, _, token = data.partition('\n')
+        self.session_token = token or None
+        return data
+
+    def resume(self):
+        """Reconnect to the server and resume the session started at login
+
+        Returns
+        -------
+        tuple
+            A tuple of (status_code, status_message) on failure.
+        None
+            On success.
+
+        Raises
+        ------
+        app.ConnectionError
+        """
+
+        self.connection.sock.close()
+        self.main_socket = self.connect(self.server_address)
+        status_code, status_message, _ = self.request('resume', '', self.session_token)
+        if status_code == '000':
+            return None
+        self.session_token = None
+        return status_code, status_message
+
     def sign_up(self, username, password, name):
         """Sign up with the given (already checked) username, password, name
 
@@ -634,8 +949,7 @@ class Client(app.App):
         command_type = ''
         data = ','.join([name, username, password])
 
-        self.send(util.package(command, command_type, data))
-        status_code, status_message, _, _ = util.extract(self.receive())
+        status_code, status_message, _ = self.request(command, command_type, data)
         if status_code == '000':
             return None
         else:
@@ -656,20 +970,43 @@ class Client(app.App):
         command_type = ''
         data = self.username
 
-        self.send(util.package(command, command_type, data))
-        status_code, status_message, _, _ = util.extract(self.receive())
+        status_code, status_message, _ = self.request(command, command_type, data)
         if status_code == '000':
+            self.session_token = None
             return None
         else:
             return status_code, status_message
     
-    def search_city(self, keyword):
+    def ping(self) -> float:
+        """Check that the connection to the server is alive
+
+        Returns
+        -------
+        float
+            The round-trip time, in seconds
+
+        Raises
+        ------
+        app.ConnectionError
+        """
+
+        start = datetime.datetime.now()
+        self.request('ping', '', '')
+        return (datetime.datetime.now() - start).total_seconds()
+
+    def search_city(self, keyword, limit=None, token=None):
         """Search a list of cities with a given keyword
 
         Parameters
         ----------
         keyword : str
 
+        limit : int
+            If given, get one page of at most limit cities. The first line of the result is then
+            <n>,<continuation token>, the token being empty on the last page.
+        token : str
+            The continuation token of the page to get, None for the first page
+
         Returns
         -------
         tuple
@@ -681,21 +1018,50 @@ class Client(app.App):
         command = 'query'
         command_type = 'city'
 
-        self.send(util.package(command, command_type, keyword))
-        status_code, status_message, _, data = util.extract(self.receive())
+        status_code, status_message, data = self.request(command, command_type, self.page_request(keyword, limit, token))
 
         if status_code == '000':
             return data
         else:
             return status_code, status_message
     
-    def query_weather_by_date(self, date):
+    def autocomplete(self, prefix, limit=None):
+        """Get the cities whose name starts with a prefix, ignoring case and diacritics
+
+        Parameters
+        ----------
+        prefix : str
+
+        limit : int
+            Maximum number of cities, the server's limit if None
+
+        Returns
+        -------
+        tuple
+            A tuple of (status_code, status_message) on failure.
+        str
+           A string, containing multiple lines on success.
+        """
+
+        data = prefix if limit is None else f'{prefix}\n{limit}'
+        status_code, status_message, data = self.request('query', 'autocomplete', data)
+
+        if status_code == '000':
+            return data
+        else:
+            return status_code, status_message
+    
+    def query_weather_by_date(self, date, limit=None, token=None):
         """Get weather information of all cities in a given date
 
         Parameters
         ----------
         day : str
             A date, in YYYY-MM-DD format.
+        limit : int
+            If given, get one page of at most limit cities (see search_city).
+        token : str
+            The continuation token of the page to get, None for the first page
 
         Returns
         -------
@@ -708,14 +1074,54 @@ class Client(app.App):
         command = 'query'
         command_type = 'weather'
 
-        self.send(util.package(command, command_type, date))
-        status_code, status_message, _, data = util.extract(self.receive())
+        status_code, status_message, data = self.request(command, command_type, self.page_request(date, limit, token))
 
         if status_code == '000':
             return data
         else:
             return status_code, status_message
     
+    def page_request(self, value, limit, token):
+        """Build the data field of a query that can be paginated
+
+        Parameters
+        ----------
+        value : str
+            The keyword or date
+        limit : int
+            The page size, None for no pagination
+        token : str
+            The continuation token, None for the first page
+
+        Returns
+        -------
+        str
+        """
+
+        if limit is None:
+            return value
+        return f'{value}\n{limit},{token or ""}'
+
+    def query_weather_by_date_stream(self, date):
+        """Get weather information of all cities in a given date, as the rows arrive
+
+        Parameters
+        ----------
+        date : str
+            A date, in YYYY-MM-DD format.
+
+        Yields
+        ------
+        list
+            A list of rows (tuples), one for each city.
+
+        Raises
+        ------
+        ClientError
+        """
+
+        return self.request_stream('query', 'weather', date)
+
     def forecast(self, city_id):
         """Obtain the 7-day weather forecast information of a given city with ID city_id
 
@@ -732,14 +1138,67 @@ class Client(app.App):
         command = 'query'
         command_type = 'forecast'
 
-        self.send(util.package(command, command_type, city_id))
-        status_code, status_message, _, data = util.extract(self.receive())
+        status_code, status_message, data = self.request(command, command_type, city_id)
 
         if status_code == '000':
             return data
         else:
             return status_code, status_message
 
+    def batch(self, requests):
+        """Execute several requests on the server in one round trip (one per MAX_BATCH_SIZE requests),
+        using the batch command
+
+        Parameters
+        ----------
+        requests : list
+            A list of (command, command_type, data). Only query commands are supported.
+
+        Returns
+        -------
+        tuple
+            A tuple of (status_code, status_message) on failure.
+        list
+            A list of (status_code, data) on success, one for each request.
+        """
+
+        results = []
+        for start in range(0, len(requests), self.MAX_BATCH_SIZE):
+            part = requests[start:start + self.MAX_BATCH_SIZE]
+            lines = [str(len(part))]
+            lines.extend(','.join(r) for r in part)
+
+            status_code, status_message, data = self.request('batch', '', '\n'.join(lines))
+            if status_code != '000':
+                return status_code, status_message
+
+            num_result, data = data.split('\n', 1)
+            pos = 0
+            for _ in range(int(num_result)):
+                end = data.index('\n', pos)
+                sub_status, size = data[pos:end].split(',')
+                pos = end + 1 + int(size)
+                results.append((sub_status, data[end + 1:pos]))
+        return results
+
+    def forecast_many(self, city_ids):
+        """Obtain the 7-day weather forecast information of several cities in one round trip
+
+        Parameters
+        ----------
+        city_ids : list
+            A list of city IDs.
+
+        Returns
+        -------
+        tuple
+            A tuple of (status_code, status_message) on failure.
+        list
+            A list of (status_code, data) on success, data being formatted as returned by forecast.
+        """
+
+        return self.batch([('query', 'forecast', str(city_id)) for city_id in city_ids])
+
     def add_city(self, city_id, city_name, country_code, lat, lon):
         """Add a new city with given information (all of them are required)
 
@@ -768,8 +1227,7 @@ class Client(app.App):
         command_type = 'city'
 
         data = ','.join([city_id, city_name, country_code, str(lat), str(lon)])
-        self.send(util.package(command, command_type, data))
-        status_code, status_message, *_ = util.extract(self.receive())
+        status_code, status_message, _ = self.request(command, command_type, data)
         if status_code == '000':
             return None
         else:
@@ -805,8 +1263,7 @@ class Client(app.App):
         command_type = 'weather'
         data = ','.join([city_id, date, weather_id, min_degree, max_degree, precipitation])
 
-        self.send(util.package(command, command_type, data))
-        status_code, status_message, *_ = util.extract(self.receive())
+        status_code, status_message, _ = self.request(command, command_type, data)
 
         if status_code == '000':
             return None
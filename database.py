@@ -1,25 +1,153 @@
 import datetime
+import pathlib
+import queue
+import re
 import sqlite3
 
+# Numbered schema changes, applied in order by Database.migrate
+MIGRATIONS_PATH = pathlib.Path(__file__).parent / 'db' / 'migrations'
+
+# Minimum version of SQLite needed by a migration, declared in a line like: -- Requires SQLite 3.34
+REQUIRES_SQLITE = re.compile(r'^-- Requires SQLite (\d+)\.(\d+)', re.MULTILINE)
+
 class DatabaseConnectionError(Exception):
     pass
 
+class ConnectionPool:
+    """Long-lived read-only connections to a database, shared by the threads of the server. A
+    connection is checked out for a request and returned afterwards, so that connections are opened
+    once, and keep their compiled statements cached from one request to the next.
+    """
+
+    def __init__(self, database_path, size):
+        """
+        Parameters
+        ----------
+        database_path : str
+
+        size : int
+            Maximum number of idle connections kept open. More connections are opened when more
+            requests read the database at once, and closed when returned to a full pool.
+        """
+
+        self.database_path = database_path
+        self.size = size
+        # The most recently returned connection is reused first, with the warmest cache
+        self.idle = queue.LifoQueue()
+
+    def get(self):
+        """Check a connection out of the pool, opening a new one if none is idle. The connection is
+        used as a context manager (with pool.get() as db: ...), and returned to the pool at the end
+        of the block, or once its lazy results are consumed (see Database.fetch).
+
+        Returns
+        -------
+        Database
+        """
+
+        try:
+            db = self.idle.get_nowait()
+        except queue.Empty:
+            db = Database(self.database_path, self, read_only=True)
+        db.checked_out = True
+        return db
+
+    def put(self, db):
+        if self.idle.qsize() < self.size:
+            self.idle.put(db)
+
+class Rows:
+    """Iterator over the rows of a cursor, fetched one by one. Its database is not returned to its
+    pool until all the rows are consumed or the iterator is discarded.
+    """
+
+    def __init__(self, db, cursor):
+        self.db = db
+        self.cursor = cursor
+        db.reading += 1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.cursor is not None:
+            row = self.cursor.fetchone()
+            if row is not None:
+                return row
+            self.close()
+        raise StopIteration
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+            self.db.reading -= 1
+            self.db.release()
+
 class Database:
     """Providing access to the server database
     """
 
-    def __init__(self, database_path):
-        self.today = datetime.date.today()
+    # Pragmas of every connection: a page cache of 16 MiB (negative sizes are in KiB), and reads
+    # through up to 256 MiB of memory-mapped file instead of read() calls
+    PRAGMAS = {
+        'foreign_keys': 1,
+        'cache_size': -16384,
+        'mmap_size': 256 * 1024 * 1024,
+    }
+
+    # Pragmas of read-write connections. In WAL mode, readers read the last committed state while
+    # a transaction is written, instead of waiting for it, and a commit only syncs the log once
+    # it is checkpointed (synchronous = NORMAL): a power loss may lose the last transactions, but
+    # never corrupts the database.
+    WRITER_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+    }
+
+    def __init__(self, database_path, pool=None, read_only=False):
+        """
+        Parameters
+        ----------
+        database_path : str
+
+        pool : ConnectionPool
+            The pool the database belongs to, if any. Pooled databases may be used by any thread,
+            one at a time.
+        read_only : bool
+            Open the database in read-only mode: modifications fail with sqlite3.OperationalError.
+        """
+
         self.con = None
+        self.pool = pool
+        self.checked_out = False
+        # Number of lazy results (Rows) not consumed yet
+        self.reading = 0
+        # Whether the full-text index of the city names can be used, checked on first use
+        self.full_text = None
         try:
-            self.con = sqlite3.connect(database_path)
+            if read_only:
+                uri = pathlib.Path(database_path).absolute().as_uri() + '?mode=ro'
+                self.con = sqlite3.connect(uri, uri=True, check_same_thread=pool is None)
+            else:
+                self.con = sqlite3.connect(database_path, check_same_thread=pool is None)
             self.cur = self.con.cursor()
-            self.cur.execute('PRAGMA foreign_keys = 1')
+            pragmas = self.PRAGMAS if read_only else {**self.PRAGMAS, **self.WRITER_PRAGMAS}
+            for name, value in pragmas.items():
+                self.cur.execute(f'PRAGMA {name} = {value}')
         except sqlite3.Error:
             raise DatabaseConnectionError(f'Cannot connect to {database_path}')
     
     def __del__(self):
-        self.con.close()
+        self.close()
+
+    def close(self):
+        if self.con is not None:
+            self.con.close()
+            self.con = None
 
     def __enter__(self):
         return self
@@ -29,6 +157,13 @@ class Database:
             self.con.commit()
         else:
             self.con.rollback()
+        self.checked_out = False
+        self.release()
+
+    @property
+    def today(self):
+        # Not cached: the database may stay open for days
+        return datetime.date.today()
 
 
     # ---------- Utility methods ----------
@@ -37,9 +172,116 @@ class Database:
         self.cur.execute(query)
         return self.cur.fetchall()
 
+    def fetch(self, query, parameters, lazy=False):
+        """Execute a query and return its result
+
+        Parameters
+        ----------
+        query : str
+        parameters : tuple
+        lazy : bool
+            If True, return an iterator over a cursor of its own, yielding the rows one by one as
+            they are iterated, instead of fetching all of them at once.
+
+        Returns
+        -------
+        list or Rows
+        """
+
+        if lazy:
+            return Rows(self, self.con.cursor().execute(query, parameters))
+        self.cur.execute(query, parameters)
+        return self.cur.fetchall()
+
+    def paginate(self, query, parameters, key, limit=None, after=None):
+        """Restrict a query (without ORDER BY) to one page of results, using keyset pagination:
+        rows are sorted by key, and a page starts right after the key of the last row of the
+        previous page, so that no row is scanned twice (unlike OFFSET).
+
+        Parameters
+        ----------
+        query : str
+        parameters : tuple
+        key : str
+            A unique column to sort by
+        limit : int
+            The page size, no pagination if None
+        after : int
+            The key of the last row of the previous page, None for the first page
+
+        Returns
+        -------
+        tuple
+            A tuple of (query, parameters).
+        """
+
+        if limit is None:
+            return query + ';', parameters
+        if after is not None:
+            query += f' AND {key} > ?'
+            parameters += (after,)
+        return query + f' ORDER BY {key} LIMIT ?;', parameters + (limit,)
+
+    def release(self):
+        """Return a pooled database to its pool, once it is neither checked out nor read by lazy
+        results
+        """
+
+        if self.pool is not None and not self.checked_out and self.reading == 0:
+            self.pool.put(self)
+
     def commit(self):
         self.con.commit()
 
+    def migrate(self, path=MIGRATIONS_PATH):
+        """Upgrade the schema in place, applying the migrations not applied yet. A migration is an
+        SQL script named <version>_<description>.sql; the version of the last migration applied
+        is recorded in the database (PRAGMA user_version). All of them are applied in a single
+        transaction, which other processes upgrading the same database wait for.
+
+        A migration requiring a more recent SQLite than the one running (see REQUIRES_SQLITE) is
+        not applied, and neither are the next ones: they are left for when SQLite is upgraded.
+
+        Parameters
+        ----------
+        path : pathlib.Path
+            The directory of the migrations
+
+        Returns
+        -------
+        list
+            The versions applied, in order.
+        """
+
+        migrations = sorted((int(file.name.split('_', 1)[0]), file) for file in path.glob('*.sql'))
+
+        self.con.commit()
+        self.cur.execute('BEGIN IMMEDIATE')
+        try:
+            self.cur.execute('PRAGMA user_version')
+            current = self.cur.fetchone()[0]
+            applied = []
+            for version, file in migrations:
+                if version <= current:
+                    continue
+                script = file.read_text()
+                required = REQUIRES_SQLITE.search(script)
+                if required and sqlite3.sqlite_version_info < tuple(map(int, required.groups())):
+                    break
+                statement = ''
+                for line in script.splitlines(keepends=True):
+                    statement += line
+                    if sqlite3.complete_statement(statement):
+                        self.cur.execute(statement)
+                        statement = ''
+                self.cur.execute(f'PRAGMA user_version = {version}')
+                applied.append(version)
+            self.con.commit()
+        except sqlite3.Error:
+            self.con.rollback()
+            raise
+        return applied
+
 
     # ---------- User-identity-related methods ----------
 
@@ -92,19 +334,25 @@ class Database:
             INSERT INTO user VALUES (?, ?, ?);
             """
             self.cur.execute(query, (username, password, name))
-            self.con.commit()
             return True
 
 
     # ---------- Weather querying methods ----------
 
-    def query_weather_by_date(self, date: str):
+    def query_weather_by_date(self, date: str, lazy=False, limit=None, after=None):
         """Retrieve weather condition of all cities in a given date
 
         Parameters
         ----------
         date : str
             In ISO 8601 format (YYYY-MM-DD).
+        lazy : bool
+            Return an iterator yielding the rows one by one instead of a list (see fetch).
+        limit : int
+            If given, return at most limit rows, sorted by city_id (keyset pagination).
+        after : int
+            If given (with limit), only return the cities whose ID is greater than after, i.e.
+            the page following the one ending with this city.
 
         Returns
         -------
@@ -121,10 +369,10 @@ class Database:
                ON cw.weather_id = wc.weather_id
                JOIN country AS ct
                ON c.country_code = ct.country_code
-        WHERE  cw.report_date = ?;
+        WHERE  cw.report_date = ?
         """
-        self.cur.execute(query, (date,))
-        return self.cur.fetchall()
+        query, parameters = self.paginate(query, (date,), 'cw.city_id', limit, after)
+        return self.fetch(query, parameters, lazy)
 
     def today_weather(self):
         """Retrieve today weather information of all cities
@@ -200,12 +448,88 @@ class Database:
 
     # ---------- Searching methods ----------
 
-    def search_city(self, name):
-        """Search city by name
+    def search_city(self, name, lazy=False, limit=None, after=None, top=100):
+        """Search city by name, the best matches first: the cities named exactly name, then the
+        ones whose name starts with name, then the others, the shortest names (the closest to
+        name) first
         
         Parameters
         ----------
         name : str
+        lazy : bool
+            Return an iterator yielding the rows one by one instead of a list (see fetch).
+        limit : int
+            If given, return at most limit rows (pagination).
+        after : int
+            If given (with limit), skip the first after matches, i.e. the previous pages.
+        top : int
+            Maximum number of matches, over all the pages
+
+        Returns
+        -------
+        list
+            A list of (city_id, city_name, country_name).
+        """
+
+        offset = max(0, after or 0)
+        count = max(0, top - offset)
+        if limit is not None:
+            count = min(count, limit)
+
+        if self.full_text is None:
+            self.full_text = self.has_city_name_index()
+
+        name = name.lower()
+        if len(name) >= 3 and self.full_text:
+            # Cities found in the full-text index, the keyword being a single phrase (so that its
+            # characters are not read as operators)
+            source = 'city_name_fts AS f JOIN city AS c ON c.city_id = f.rowid'
+            condition = 'city_name_fts MATCH ?'
+            keyword = '"' + name.replace('"', '""') + '"'
+        else:
+            # Too short for the trigrams of the index, or no index (see has_city_name_index)
+            source = 'city AS c'
+            condition = 'c.city_name LIKE ?'
+            keyword = '%' + name + '%'
+
+        query = f'''
+        SELECT c.city_id, c.city_name, ct.country_name
+        FROM {source} JOIN country AS ct ON c.country_code = ct.country_code
+        WHERE {condition}
+        ORDER BY c.city_name LIKE ? DESC, c.city_name LIKE ? DESC, length(c.city_name), c.city_id
+        LIMIT ? OFFSET ?;
+        '''
+        return self.fetch(query, (keyword, name, name + '%', count, offset), lazy)
+
+    def has_city_name_index(self) -> bool:
+        """Check whether the full-text index of the city names (migration 003) exists and can be
+        read: it is missing when the server runs with SQLite older than 3.34
+        """
+
+        if sqlite3.sqlite_version_info < (3, 34):
+            return False
+        self.cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'city_name_fts'")
+        return self.cur.fetchone() is not None
+
+    def city_version(self) -> int:
+        """A number changing whenever the city table is modified (migration 004), to tell when to
+        reload the cities kept in memory. Without migration 004 (held back on SQLite older than
+        3.34, see migrate), the number of cities is used instead.
+        """
+
+        try:
+            self.cur.execute('SELECT version FROM city_version')
+        except sqlite3.OperationalError:
+            self.cur.execute('SELECT count(*) FROM city')
+        return self.cur.fetchone()[0]
+
+    def list_cities(self, city_id=None):
+        """Retrieve all the cities, or only one
+
+        Parameters
+        ----------
+        city_id : int
+            If given, the ID of the only city to retrieve
 
         Returns
         -------
@@ -216,14 +540,55 @@ class Database:
         query = '''
         SELECT c.city_id, c.city_name, ct.country_name
         FROM city AS c JOIN country AS ct ON c.country_code = ct.country_code
-        WHERE city_name LIKE ?;
         '''
 
-        name = name.lower()
-        name = '%' + name + '%'
-        self.cur.execute(query, (name,))
+        if city_id is None:
+            self.cur.execute(query)
+        else:
+            self.cur.execute(query + 'WHERE c.city_id = ?', (city_id,))
         return self.cur.fetchall()
 
+    def compression_dictionary(self, size=32768):
+        """Build a preset compression dictionary from the names repeating the most in query results:
+        country names, weather conditions and common city names
+
+        Parameters
+        ----------
+        size : int
+            Maximum size of the dictionary, in bytes (zlib uses at most 32 KiB)
+
+        Returns
+        -------
+        str
+            The names, one per line, the most frequent ones at the end (where zlib finds them
+            the cheapest).
+        """
+
+        query = '''
+        SELECT name FROM (
+            SELECT ct.country_name AS name, COUNT(*) AS n
+            FROM city AS c JOIN country AS ct ON c.country_code = ct.country_code
+            GROUP BY ct.country_name
+            UNION ALL
+            SELECT main AS name, 1000000 AS n FROM weather_condition GROUP BY main
+            UNION ALL
+            SELECT city_name AS name, COUNT(*) AS n FROM city
+            GROUP BY city_name HAVING COUNT(*) > 1
+        )
+        ORDER BY n DESC;
+        '''
+
+        self.cur.execute(query)
+        names = []
+        total = 0
+        for (name,) in self.cur:
+            total += len(name.encode()) + 1
+            if total > size:
+                break
+            names.append(name)
+        names.reverse()
+        return '\n'.join(names)
+
 
     # ---------- Database modification methods ----------
 
@@ -246,7 +611,6 @@ class Database:
         '''
         try:
             self.cur.execute(query, city_info)
-            self.con.commit()
             return True
         except sqlite3.DatabaseError:
             return False
@@ -0,0 +1,14 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database
+
+# Upgrade the schema of an existing database (the server also does it when it starts)
+path = sys.argv[1] if len(sys.argv) > 1 else 'weather.db'
+db = database.Database(path)
+applied = db.migrate()
+if applied:
+    print('Applied migrations', ', '.join(map(str, applied)))
+else:
+    print('Already up to date')
@@ -0,0 +1,5 @@
+-- Weather of all cities on a date (query weather): the primary key starts with city_id, so
+-- without this index every report of every date is scanned. Sorted by city_id within a date for
+-- keyset pagination, and covering all the columns of city_weather that the queries read.
+CREATE INDEX city_weather_report_date
+    ON city_weather(report_date, city_id, weather_id, min_degree, max_degree, precipitation);
@@ -0,0 +1,3 @@
+-- Cities of a country: joins from country to city, cascaded deletions of countries, and the
+-- city names counted by country (compression dictionary), read from the index alone.
+CREATE INDEX city_country_code ON city(country_code, city_name);
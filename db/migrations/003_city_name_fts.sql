@@ -0,0 +1,23 @@
+-- Requires SQLite 3.34
+-- Full-text index of the city names, for searching the cities whose name contains a keyword
+-- without scanning the city table. The trigram tokenizer (SQLite 3.34 and above) indexes every
+-- sequence of 3 characters, matching any substring of at least 3 characters, regardless of case.
+-- The index reads the names from the city table (external content), and triggers keep it up to date.
+CREATE VIRTUAL TABLE city_name_fts USING fts5(
+    city_name, content='city', content_rowid='city_id', tokenize='trigram'
+);
+
+INSERT INTO city_name_fts(city_name_fts) VALUES ('rebuild');
+
+CREATE TRIGGER city_name_fts_insert AFTER INSERT ON city BEGIN
+    INSERT INTO city_name_fts(rowid, city_name) VALUES (new.city_id, new.city_name);
+END;
+
+CREATE TRIGGER city_name_fts_delete AFTER DELETE ON city BEGIN
+    INSERT INTO city_name_fts(city_name_fts, rowid, city_name) VALUES ('delete', old.city_id, old.city_name);
+END;
+
+CREATE TRIGGER city_name_fts_update AFTER UPDATE OF city_id, city_name ON city BEGIN
+    INSERT INTO city_name_fts(city_name_fts, rowid, city_name) VALUES ('delete', old.city_id, old.city_name);
+    INSERT INTO city_name_fts(rowid, city_name) VALUES (new.city_id, new.city_name);
+END;
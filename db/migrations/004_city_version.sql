@@ -0,0 +1,17 @@
+-- Number of modifications of the city table, for the servers keeping the cities in memory (the
+-- autocompletion index) to tell when to reload them, whichever process modified the table.
+CREATE TABLE city_version (version INTEGER NOT NULL);
+
+INSERT INTO city_version VALUES (0);
+
+CREATE TRIGGER city_version_insert AFTER INSERT ON city BEGIN
+    UPDATE city_version SET version = version + 1;
+END;
+
+CREATE TRIGGER city_version_delete AFTER DELETE ON city BEGIN
+    UPDATE city_version SET version = version + 1;
+END;
+
+CREATE TRIGGER city_version_update AFTER UPDATE ON city BEGIN
+    UPDATE city_version SET version = version + 1;
+END;
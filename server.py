@@ -1,6 +1,25 @@
+import argparse
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextvars
 import datetime
+import itertools
+import math
+import multiprocessing
+import os
+import queue
+import random
+import secrets
+import selectors
 import socket
+import sqlite3
+import sys
 import threading
+import time
+import traceback
+import unicodedata
 
 import app
 import database
@@ -17,444 +36,2867 @@ def get_ip_address():
 	except Exception:
 		raise app.ConnectionError('Unable to get IP address')
 
-class Server(app.App):
+class WorkerPool:
+    """A fixed number of threads executing tasks, with a queue of bounded depth in front of them.
+    Submitting a task blocks while the queue is full.
+    """
+
+    def __init__(self, workers, queue_depth, report=None):
+        """
+        Parameters
+        ----------
+        workers : int
+            Number of threads
+        queue_depth : int
+            Maximum number of tasks waiting for a thread
+        report : function
+            Called after each task with the time it waited in the queue and the time it took to
+            execute (in seconds)
+        """
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='worker')
+        self.slots = threading.BoundedSemaphore(workers + queue_depth)
+        self.report = report
+
+    def submit(self, fn, *args):
+        """Execute fn(*args) in a worker thread, in the current context (see contextvars)
+        """
+
+        self.slots.acquire()
+        self.executor.submit(self.execute, time.perf_counter(), contextvars.copy_context(), fn, args)
+
+    def execute(self, submitted, context, fn, args):
+        started = time.perf_counter()
+        try:
+            context.run(fn, *args)
+        finally:
+            self.slots.release()
+            if self.report is not None:
+                self.report(started - submitted, time.perf_counter() - started)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+class AdmissionController:
+    """Limit the number of clients served at the same time. Clients coming when the server is full
+    wait in a FIFO queue of bounded size, and are admitted as other clients leave.
+
+    Clients get a ticket (a concurrent.futures.Future) when they arrive, which is done once they
+    are admitted. Clients giving up on waiting withdraw their ticket.
+    """
+
+    def __init__(self, capacity, queue_size, report=None):
+        """
+        Parameters
+        ----------
+        capacity : int
+            Maximum number of clients served at the same time
+        queue_size : int
+            Maximum number of waiting clients
+        report : function
+            Called with the number of waiting clients and the average waiting time (in seconds)
+            whenever they change
+        """
+
+        self.capacity = capacity
+        self.queue_size = queue_size
+        self.report = report
+
+        self.lock = threading.Lock()
+        self.active = 0
+        self.waiting = collections.deque()
+        self.closed = False
+
+        # Averages of the time clients wait before being admitted, and stay once admitted
+        self.average_wait = 0.0
+        self.average_stay = 1.0
+
+    def enter(self):
+        """Ask for admission
+
+        Returns
+        -------
+        concurrent.futures.Future
+            The ticket of the client, done once it is admitted (possibly right away) with the
+            result True, or refused (see close) with the result False.
+        None
+            If the queue is full, or the controller is closed.
+        """
+
+        ticket = concurrent.futures.Future()
+        ticket.queued = time.monotonic()
+        with self.lock:
+            if self.closed:
+                return None
+            if self.active < self.capacity and not self.waiting:
+                self.admit(ticket)
+                return ticket
+            if len(self.waiting) >= self.queue_size:
+                return None
+            self.waiting.append(ticket)
+        self.publish()
+        return ticket
+
+    def withdraw(self, ticket) -> bool:
+        """Give up waiting
+
+        Returns
+        -------
+        bool
+            True if the ticket was withdrawn, False if the client was admitted in the meantime (it
+            must then leave as usual).
+        """
+
+        with self.lock:
+            try:
+                self.waiting.remove(ticket)
+            except ValueError:
+                return False
+        self.publish()
+        return True
+
+    def leave(self, ticket):
+        """Free the place of an admitted client, and admit the next waiting client
+        """
+
+        with self.lock:
+            self.active -= 1
+            self.average_stay += (time.monotonic() - ticket.admitted - self.average_stay) * 0.1
+            if self.waiting:
+                self.admit(self.waiting.popleft())
+        self.publish()
+
+    def close(self):
+        """Refuse all the clients from now on, including the waiting ones
+        """
+
+        with self.lock:
+            self.closed = True
+            waiting, self.waiting = self.waiting, collections.deque()
+        for ticket in waiting:
+            ticket.set_result(False)
+        self.publish()
+
+    def admit(self, ticket):
+        # Called with lock held
+        ticket.admitted = time.monotonic()
+        self.active += 1
+        self.average_wait += (ticket.admitted - ticket.queued - self.average_wait) * 0.1
+        ticket.set_result(True)
+
+    def retry_after(self) -> int:
+        """Estimate the number of seconds after which a rejected client should try again
+        """
+
+        with self.lock:
+            # Places free up at a rate of about capacity / average_stay
+            estimate = (len(self.waiting) + 1) * self.average_stay / self.capacity
+
+        # Spread the retries so that rejected clients do not all come back at once
+        return max(1, round(estimate * random.uniform(1.0, 1.5)))
+
+    def publish(self):
+        if self.report is not None:
+            self.report(len(self.waiting), self.average_wait)
+
+class DatabaseWriter:
+    """A single thread applying all the modifications of the database. Modifications submitted
+    while the previous transaction is being committed, or shortly after, are committed together in
+    one transaction (group commit).
+    """
+
+    def __init__(self, database_path, max_delay, max_batch):
+        """
+        Parameters
+        ----------
+        database_path : str
+
+        max_delay : float
+            Time to wait for more modifications after the first one of a transaction, in seconds
+        max_batch : int
+            Maximum number of modifications in one transaction
+        """
+
+        self.database_path = database_path
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.pending = queue.SimpleQueue()
+        self.opened = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='writer', daemon=True)
+
+    def start(self):
+        """Start the writer thread, and wait until it has opened the database (which switches it
+        to WAL mode and upgrades its schema, before the read-only connections open it)
+
+        Raises
+        ------
+        database.DatabaseConnectionError or sqlite3.Error
+            If the database cannot be opened or upgraded. The writer thread is then stopped, and
+            the server cannot run without it.
+        """
+
+        self.thread.start()
+        self.opened.wait()
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, fn, *args) -> concurrent.futures.Future:
+        """Execute fn(db, *args) in the writer thread, db being its database.Database
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Done with the result of fn once the transaction is committed
+        """
+
+        done = concurrent.futures.Future()
+        self.pending.put((fn, args, done))
+        return done
+
+    def run(self):
+        db = None
+        try:
+            db = database.Database(self.database_path)
+            db.migrate()
+        except Exception as e:
+            # Raised by start. The database is closed by the thread that opened it.
+            if db is not None:
+                db.close()
+            self.error = e
+            return
+        finally:
+            self.opened.set()
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.pending.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            results = []
+            for fn, args, done in batch:
+                try:
+                    results.append((done, fn(db, *args), None))
+                except Exception as e:
+                    results.append((done, None, e))
+
+            try:
+                db.commit()
+            except sqlite3.Error as e:
+                db.con.rollback()
+                results = [(done, None, e) for done, _, _ in results]
+
+            for done, result, error in results:
+                if error is None:
+                    done.set_result(result)
+                else:
+                    done.set_exception(error)
+
+class TokenBucket:
+    """Tokens of a client for a command, refilled at a constant rate (see RateLimiter)
+    """
+
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+class RateLimiter:
+    """Limit the rate of the requests of each client, by command, with token buckets. A client is
+    identified by several keys (e.g. its IP address and its username), each with its own buckets: a
+    request is accepted only if all of them have enough tokens.
+    """
+
+    def __init__(self, limits):
+        """
+        Parameters
+        ----------
+        limits : dict
+            Tuples of (rate, burst) by command: buckets are refilled with rate tokens per second,
+            and hold at most burst tokens. Commands not in limits are not limited.
+        """
+
+        self.limits = limits
+        self.lock = threading.Lock()
+
+        # Buckets by (key, command). Full buckets are forgotten (see forget_full).
+        self.buckets = dict()
+
+    def acquire(self, keys, command, cost=1) -> float:
+        """Take cost tokens from the buckets of a client for a command
+
+        Parameters
+        ----------
+        keys : list
+            The keys identifying the client
+        command : str
+
+        cost : int
+            At most the burst of the command, or the request is never accepted
+
+        Returns
+        -------
+        float
+            0 if the request is accepted, otherwise the number of seconds after which it would be
+        """
+
+        if command not in self.limits:
+            return 0.0
+        rate, burst = self.limits[command]
+
+        now = time.monotonic()
+        wait = 0.0
+        buckets = []
+        with self.lock:
+            for key in keys:
+                bucket = self.buckets.get((key, command))
+                if bucket is None:
+                    bucket = self.buckets[(key, command)] = TokenBucket(burst, now)
+                bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+                bucket.updated = now
+                wait = max(wait, (cost - bucket.tokens) / rate)
+                buckets.append(bucket)
+
+            if wait > 0:
+                return wait
+            for bucket in buckets:
+                bucket.tokens -= cost
+        return 0.0
+
+    def forget_full(self):
+        """Forget the buckets that are full again, so that only the clients recently active take
+        memory
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            for key, command in list(self.buckets):
+                rate, burst = self.limits[command]
+                bucket = self.buckets[(key, command)]
+                if bucket.tokens + (now - bucket.updated) * rate >= burst:
+                    del self.buckets[(key, command)]
+
+class CityIndex:
+    """In-memory index of the city names, for autocompletion. The names are normalized (see
+    normalize) and kept sorted, so that the cities whose name starts with a prefix are found by
+    binary search.
+    """
+
+    # Letters that Unicode does not decompose into a base letter and a diacritic
+    LETTERS = str.maketrans('đĐøØłŁ', 'dDoOlL')
+
+    def __init__(self, cities):
+        """
+        Parameters
+        ----------
+        cities : iterable
+            Tuples of (city_id, city_name, country_name)
+        """
+
+        self.lock = threading.Lock()
+        self.countries = dict()
+        entries = sorted((self.normalize(city[1]), self.share(city)) for city in cities)
+        self.keys = [key for key, _ in entries]
+        self.cities = [city for _, city in entries]
+
+        # Approximate memory used by the index, in bytes: the lists, and the objects they hold
+        # (the country names being shared by the cities)
+        self.size = sys.getsizeof(self.keys) + sys.getsizeof(self.cities)
+        self.size += sum(sys.getsizeof(name) for name in self.countries)
+        for key, city in zip(self.keys, self.cities):
+            self.size += self.entry_size(key, city)
+
+    @classmethod
+    def normalize(cls, name) -> str:
+        """Casefold a name and strip its diacritics, e.g. 'São Paulo' -> 'sao paulo'
+        """
+
+        decomposed = unicodedata.normalize('NFKD', name.translate(cls.LETTERS))
+        return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+    def share(self, city) -> tuple:
+        """Return the city with the same country name object as the other cities of its country
+        """
+
+        city_id, city_name, country_name = city
+        return (city_id, city_name, self.countries.setdefault(country_name, country_name))
+
+    @staticmethod
+    def entry_size(key, city) -> int:
+        return sys.getsizeof(key) + sys.getsizeof(city) + sys.getsizeof(city[0]) + sys.getsizeof(city[1])
+
+    def add(self, city):
+        """Add a new city
+
+        Parameters
+        ----------
+        city : tuple
+            A tuple of (city_id, city_name, country_name)
+        """
+
+        key = self.normalize(city[1])
+        with self.lock:
+            if city[2] not in self.countries:
+                self.size += sys.getsizeof(city[2])
+            city = self.share(city)
+            i = bisect.bisect_right(self.keys, key)
+            self.keys.insert(i, key)
+            self.cities.insert(i, city)
+            self.size += self.entry_size(key, city)
+
+    def complete(self, prefix, n) -> list:
+        """Find the cities whose name starts with a prefix (both normalized)
+
+        Parameters
+        ----------
+        prefix : str
+
+        n : int
+            Maximum number of cities
+
+        Returns
+        -------
+        list
+            At most n tuples of (city_id, city_name, country_name), sorted by normalized name.
+        """
+
+        prefix = self.normalize(prefix)
+        with self.lock:
+            start = bisect.bisect_left(self.keys, prefix)
+            end = min(start + n, len(self.keys))
+            for i in range(start, end):
+                if not self.keys[i].startswith(prefix):
+                    end = i
+                    break
+            return self.cities[start:end]
+
+class ConnectedClient:
+    """A client connected to the server, and the user logged in on its connection (if any)
+    """
+
+    __slots__ = (
+        'connection', 'ticket', 'address', 'username', 'role', 'login_time', 'requests', 'last_active',
+        'let_go'
+    )
+
+    def __init__(self, connection, ticket):
+        """
+        Parameters
+        ----------
+        connection : app.Connection
+
+        ticket : concurrent.futures.Future
+            The admission ticket of the client (see AdmissionController)
+        """
+
+        self.connection = connection
+        self.ticket = ticket
+        self.username = None
+
+        # IP address of the client
+        try:
+            self.address = connection.sock.getpeername()[0]
+        except OSError:
+            self.address = ''
+        self.role = None
+        self.login_time = None
+
+        # Number of requests read and not answered yet (waiting for a worker or being executed),
+        # and time the last one was read (see time.monotonic)
+        self.requests = 0
+        self.last_active = time.monotonic()
+
+        # Time the client was sent a goaway message (see time.monotonic), after which its requests
+        # are ignored. None until then.
+        self.let_go = None
+
+class LoginTable:
+    """The users logged in and the sessions, shared by all the processes in the multi-process mode
+    (see serve), so that a user is logged in only once across them and a session can be resumed on
+    any of them. The tables are then kept by a multiprocessing manager owned by the parent process.
+    """
+
+    def __init__(self, manager=None):
+        """
+        Parameters
+        ----------
+        manager : multiprocessing.managers.SyncManager
+            Manager keeping the tables, None to keep them in this process
+        """
+
+        if manager is None:
+            self.lock = threading.Lock()
+            self.users = dict()
+            self.sessions = dict()
+        else:
+            self.lock = manager.Lock()
+            self.users = manager.dict()
+            self.sessions = manager.dict()
+
+        # self.users maps each username to the IDs of the processes it is logged in on, once per
+        # connection. self.sessions maps each session token to a tuple of (username, name, role,
+        # expiry time).
+
+    def logged_in(self, username) -> bool:
+        """Check if the username is logged in on any connection, in any process
+        """
+
+        return username in self.users
+
+    def log_in(self, username, exclusive=True) -> bool:
+        """Record a user logging in on a connection of this process
+
+        Returns
+        -------
+        bool
+            False if the user is already logged in and exclusive is True
+        """
+
+        with self.lock:
+            processes = self.users.get(username, ())
+            if exclusive and processes:
+                return False
+            self.users[username] = processes + (os.getpid(),)
+        return True
+
+    def log_out(self, username):
+        """Record a user logging out of a connection of this process
+        """
+
+        with self.lock:
+            processes = list(self.users.get(username, ()))
+            if os.getpid() in processes:
+                processes.remove(os.getpid())
+            if processes:
+                self.users[username] = tuple(processes)
+            else:
+                self.users.pop(username, None)
+
+    def forget_process(self, pid):
+        """Log out the users of a process that exited
+        """
+
+        with self.lock:
+            for username, processes in self.users.items():
+                if pid not in processes:
+                    continue
+                processes = tuple(p for p in processes if p != pid)
+                if processes:
+                    self.users[username] = processes
+                else:
+                    del self.users[username]
+
+class ClientRegistry:
+    """The connected clients, indexed by connection. A user may be logged in on more than one
+    connection when resuming a session (see Server.request_resume).
+    """
+
+    def __init__(self, logins):
+        """
+        Parameters
+        ----------
+        logins : LoginTable
+            The users logged in, possibly on the connections of other processes
+        """
+
+        self.lock = threading.Lock()
+        self.by_connection = dict()
+        self.logins = logins
+
+        # Notified when a client is removed
+        self.removed = threading.Condition(self.lock)
+
+        # Whether the server is shutting down (see close)
+        self.closing = False
+
+    def __len__(self):
+        return len(self.by_connection)
+
+    def __getitem__(self, connection) -> ConnectedClient:
+        return self.by_connection[connection]
+
+    def connections(self) -> list:
+        """The connections of all the clients
+        """
+
+        with self.lock:
+            return list(self.by_connection)
+
+    def add(self, connection, ticket) -> ConnectedClient:
+        """Register the client of a new connection
+        """
+
+        client = ConnectedClient(connection, ticket)
+        with self.lock:
+            self.by_connection[connection] = client
+        return client
+
+    def remove(self, connection) -> tuple:
+        """Forget the client of a terminated connection, logging its user out
+
+        Returns
+        -------
+        tuple
+            A tuple of (client, username), username being the user that was logged in on the
+            connection (None if there was none)
+        """
+
+        with self.lock:
+            client = self.by_connection.pop(connection)
+            username = client.username
+            self.forget_user(client)
+            self.removed.notify_all()
+        return client, username
+
+    def begin_request(self, connection) -> ConnectedClient:
+        """Count a request of a client as in flight, as soon as it is read: a request waiting for a
+        thread to execute it keeps its client from being let go (see close) until it is answered
+
+        Returns
+        -------
+        ConnectedClient
+            None if the connection is already terminated, or the client was let go
+        """
+
+        with self.lock:
+            client = self.by_connection.get(connection)
+            if client is None or client.let_go is not None:
+                return None
+            client.requests += 1
+            client.last_active = time.monotonic()
+        return client
+
+    def end_request(self, client) -> bool:
+        """Count a request of a client as answered
+
+        Returns
+        -------
+        bool
+            True if the server is shutting down and the client has no more requests in flight, in
+            which case the client is let go
+        """
+
+        with self.lock:
+            client.requests -= 1
+            if self.closing and client.requests == 0:
+                client.let_go = time.monotonic()
+                return True
+            return False
+
+    def idle_clients(self, since) -> list:
+        """The clients without requests in flight, and without requests read since a given time
+        (see time.monotonic)
+        """
+
+        with self.lock:
+            return [
+                client for client in self.by_connection.values()
+                if client.requests == 0 and client.last_active < since
+            ]
+
+    def close(self) -> list:
+        """Mark the server as shutting down, and let go the clients without requests in flight
+
+        Returns
+        -------
+        list
+            The clients let go
+        """
+
+        with self.lock:
+            self.closing = True
+            idle = [client for client in self.by_connection.values() if client.requests == 0]
+            now = time.monotonic()
+            for client in idle:
+                client.let_go = now
+            return idle
+
+    def let_go_before(self, since) -> list:
+        """The clients let go before a given time (see time.monotonic)
+        """
+
+        with self.lock:
+            return [
+                client for client in self.by_connection.values()
+                if client.let_go is not None and client.let_go < since
+            ]
+
+    def wait_until_empty(self, timeout) -> bool:
+        """Wait for all the clients to be removed, for at most timeout seconds
+
+        Returns
+        -------
+        bool
+            False if some clients are left
+        """
+
+        with self.removed:
+            return self.removed.wait_for(lambda: not self.by_connection, timeout)
+
+    def logged_in(self, username) -> bool:
+        """Check if the username is logged in on any connection
+        """
+
+        return self.logins.logged_in(username)
+
+    def log_in(self, client, username, role, exclusive=True) -> bool:
+        """Record a user logging in on the connection of a client
+
+        Parameters
+        ----------
+        client : ConnectedClient
+
+        username : str
+
+        role : str
+            'ordinary' or 'admin'
+        exclusive : bool
+            Whether to refuse the user if it is already logged in on another connection
+
+        Returns
+        -------
+        bool
+            False if the user is refused
+        """
+
+        with self.lock:
+            if not self.logins.log_in(username, exclusive):
+                return False
+            self.forget_user(client)
+            client.username = username
+            client.role = role
+            client.login_time = datetime.datetime.now()
+        return True
+
+    def log_out(self, client) -> str:
+        """Record the user of a client logging out
+
+        Returns
+        -------
+        str
+            The username, None if no user was logged in
+        """
+
+        with self.lock:
+            username = client.username
+            self.forget_user(client)
+        return username
+
+    def forget_user(self, client):
+        # Called with lock held
+        if client.username is None:
+            return
+        self.logins.log_out(client.username)
+        client.username = client.role = client.login_time = None
+
+# Connection of the client whose request is being handled. Set by the thread (or asyncio task)
+# serving the connection, and copied to the threads it hands requests to.
+current_connection = contextvars.ContextVar('current_connection')
+
+class ThreadCounters:
+    """Counters of the statistics, each updated by a single thread (see StatisticsCollector)
+    """
+
+    __slots__ = ('connections', 'users', 'requests', 'timed_requests', 'queue_wait', 'execution_time')
+
+    def __init__(self):
+        self.connections = 0
+        self.users = 0
+        self.requests = 0
+
+        # Number of requests timed, and the sums of their times in seconds
+        self.timed_requests = 0
+        self.queue_wait = 0.0
+        self.execution_time = 0.0
+
+    def add(self, other):
+        for name in self.__slots__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+class StatisticsCollector:
+    """Statistics displayed in the main window, collected without blocking the requests: each
+    thread updates its own counters, and the activities are queued. The main window collects them a
+    few times per second (see collect), and is the only one touching Tk.
+    """
+
     def __init__(self):
+        self.local = threading.local()
+
+        # Counters of each thread, and the sum of the counters of the threads that ended. The lock
+        # is only taken once per thread, and when collecting.
+        self.lock = threading.Lock()
+        self.threads = []
+        self.retired = ThreadCounters()
+
+        # Rows of the User Activities table, not displayed yet
+        self.activities = queue.SimpleQueue()
+
+        # Number of clients waiting for admission and their average wait, replaced as a whole
+        self.admission = (0, 0.0)
+
+        # Memory used by the autocompletion index of this process (see CityIndex), in bytes
+        self.index_size = 0
+
+        # Latest totals and admission figures sent by the worker processes of the multi-process
+        # mode, by process ID (see merge)
+        self.remote = dict()
+
+        # Totals at the last collect, to average the times of the requests timed since then
+        self.collected = ThreadCounters()
+
+    def counters(self) -> ThreadCounters:
+        """The counters of the current thread
+        """
+
+        counters = getattr(self.local, 'counters', None)
+        if counters is None:
+            counters = self.local.counters = ThreadCounters()
+            with self.lock:
+                self.threads.append((threading.current_thread(), counters))
+        return counters
+
+    def count_request(self, address, command):
+        self.counters().requests += 1
+        self.activities.put((address, command, datetime.datetime.now().isoformat()))
+
+    def count_connections(self, n):
+        self.counters().connections += n
+
+    def count_users(self, n):
+        self.counters().users += n
+
+    def count_request_times(self, queue_wait, execution_time):
+        counters = self.counters()
+        counters.timed_requests += 1
+        counters.queue_wait += queue_wait
+        counters.execution_time += execution_time
+
+    def set_admission(self, queue_length, average_wait):
+        self.admission = (queue_length, average_wait)
+
+    def set_index_size(self, size):
+        self.index_size = size
+
+    def totals(self) -> ThreadCounters:
+        """Sum the counters of all the threads of this process
+        """
+
+        totals = ThreadCounters()
+        with self.lock:
+            threads = []
+            for thread, counters in self.threads:
+                if thread.is_alive():
+                    threads.append((thread, counters))
+                else:
+                    self.retired.add(counters)
+            self.threads = threads
+            totals.add(self.retired)
+        for _, counters in threads:
+            totals.add(counters)
+        return totals
+
+    def take_activities(self) -> list:
+        activities = []
+        while True:
+            try:
+                activities.append(self.activities.get_nowait())
+            except queue.Empty:
+                return activities
+
+    def merge(self, pid, totals, admission, activities):
+        """Add the statistics sent by a worker process (see Server.report_statistics)
+        """
+
+        self.remote[pid] = (totals, admission)
+        for row in activities:
+            self.activities.put(row)
+
+    def collect(self) -> tuple:
+        """Collect the statistics to display in the main window
+
+        Returns
+        -------
+        tuple
+            A tuple of (statistics, activities), statistics being a dict of the values by name
+            (see widget.Statistics.show), and activities the list of new rows of the User Activities
+            table.
+        """
+
+        totals = self.totals()
+        waiting_clients, admission_wait = self.admission
+        for counters, (queue_length, average_wait) in list(self.remote.values()):
+            totals.add(counters)
+            waiting_clients += queue_length
+            admission_wait = max(admission_wait, average_wait)
+
+        statistics = {
+            'activeconnections': totals.connections,
+            'activeusers': totals.users,
+            'requestsmade': totals.requests,
+            'waitingclients': waiting_clients,
+            'admissionwait': admission_wait,
+            'indexsize': self.index_size,
+        }
+
+        # Average times of the requests timed since the last collect
+        timed_requests = totals.timed_requests - self.collected.timed_requests
+        if timed_requests:
+            statistics['queuewait'] = (totals.queue_wait - self.collected.queue_wait) / timed_requests
+            statistics['executiontime'] = (totals.execution_time - self.collected.execution_time) / timed_requests
+        self.collected = totals
+
+        return statistics, self.take_activities()
+
+class Server(app.App):
+    def __init__(self, reuse_port=False, events=None, logins=None):
+        """
+        Parameters
+        ----------
+        reuse_port : bool
+            Allow other processes to listen on the same port (SO_REUSEPORT), for the
+            multi-process mode
+        events : multiprocessing.Queue
+            Only for worker processes of the multi-process mode: queue to send the statistics to
+            the parent process, which also owns the main window and the discovery thread
+        logins : LoginTable
+            Only for the multi-process mode: the users logged in and the sessions of all the
+            processes. None to keep them in this process.
+        """
         super().__init__()
 
-        self.DATABASE_PATH = 'db/weather.db'
-        self.SERVER_ADDRESS = get_ip_address()
-        self.MAX_CLIENT_THREADS = 2
+        self.DATABASE_PATH = 'db/weather.db'
+        self.SERVER_ADDRESS = get_ip_address()
+        self.MAX_CLIENT_THREADS = 2
+
+        # Clients coming when MAX_CLIENT_THREADS clients are served wait for their turn, up to
+        # ADMISSION_MAX_WAIT seconds. When the queue is full, they are rejected right away.
+        self.ADMISSION_QUEUE_SIZE = 16
+        self.ADMISSION_MAX_WAIT = 3.0
+
+        # Time given to the requests being executed to finish when the server is closed
+        self.SHUTDOWN_DEADLINE = 5.0
+
+        # Time given to the clients sent a goaway message to close their side of the connection,
+        # before it is aborted
+        self.GOAWAY_TIMEOUT = 0.5
+
+        # Rate limits of the requests, by command: each client can make rate requests per second on
+        # average, and up to burst requests at once. Clients are limited both by IP address and by
+        # username (see RateLimiter). A batch counts as one query per sub-request, and has at most
+        # MAX_BATCH_SIZE of them (no more than the burst of queries, or it would never be accepted).
+        self.RATE_LIMITS = {
+            'query': (20.0, 40),
+            'update': (50.0, 100),
+            'login': (1.0, 5),
+            'signup': (0.2, 3),
+        }
+        self.MAX_BATCH_SIZE = 40
+
+        # Connections without requests for IDLE_TIMEOUT seconds are closed, checked every
+        # REAP_INTERVAL seconds. Clients send ping requests to keep their connection open. The
+        # autocompletion index is reloaded at the same interval if cities were added by another
+        # process (see reload_city_index).
+        self.IDLE_TIMEOUT = 300.0
+        self.REAP_INTERVAL = 10.0
+
+        # Modifications of the database are committed together, up to WRITE_BATCH_SIZE of them: the
+        # ones submitted while the previous transaction is committed, and the ones coming within
+        # WRITE_BATCH_DELAY seconds after (see DatabaseWriter). Worth raising only on slow disks.
+        self.WRITE_BATCH_DELAY = 0.0
+        self.WRITE_BATCH_SIZE = 256
+
+        # Time a request waits for its modification to be committed before giving up, in seconds
+        self.WRITE_TIMEOUT = 10.0
+
+        # Queries are read from long-lived read-only connections (see database.ConnectionPool), up
+        # to DATABASE_POOL_SIZE of them kept open while idle. Only the DatabaseWriter writes.
+        self.DATABASE_POOL_SIZE = 8
+
+        # Optional protocol features a client can ask for during the connect handshake
+        self.FEATURES = ('binary', 'pipeline', 'zlib', 'zdict', 'stream', 'binrows', 'session')
+
+        # Time a session can be resumed after the last login or resume
+        self.SESSION_LIFETIME = datetime.timedelta(hours=12)
+
+        # Column types of the rows of each query, for clients receiving them in binary (see
+        # util.encode_rows)
+        self.ROW_SCHEMAS = {
+            'city': 'iss',
+            'autocomplete': 'iss',
+            'weather': 'issdsfff',
+            'forecast': 'issdsfff',
+        }
+
+        # Maximum number of rows in a page of a paginated query
+        self.MAX_PAGE_SIZE = 1000
+
+        # Maximum number of cities found by a city search, the best matches first
+        self.SEARCH_LIMIT = 100
+
+        # Maximum number of cities suggested by an autocomplete query
+        self.AUTOCOMPLETE_LIMIT = 10
+
+        # Number of rows in each chunk of a streamed response
+        self.STREAM_CHUNK_ROWS = 500
+
+        # Responses smaller than this (in bytes) are not compressed
+        self.COMPRESSION_THRESHOLD = 1024
+
+        # Commands that do not depend on the state of the connection. When pipelined (sent with a
+        # request ID), they are executed in the background and answered as soon as they are done.
+        self.PIPELINED_COMMANDS = ('query', 'batch')
+        self.PIPELINE_WORKERS = 4
+
+        # Dictionary translating status codes to status messages
+        self.STATUS_MESSAGES = {
+            '000': 'OK',
+            '001': 'Reached maximum client',
+            '002': 'Invalid request',
+            '003': 'Too many requests',
+            '100': 'Username or password not found',
+            '101': 'Already logged in',
+            '102': 'Username already existed',
+            '103': 'Already logged out',
+            '104': 'Not admin',
+            '105': 'Session expired',
+            '300': 'Permission denied',
+            '301': 'Could not add city',
+            '302': 'Could not update weather information'
+        }
+
+        # Dictionary translating from command to the corresponding handle methods
+        self.REQUESTS = {
+            'login': self.request_login,
+            'signup': self.request_signup,
+            'logout': self.request_logout,
+            'resume': self.request_resume,
+            'ping': self.request_ping,
+            'query': self.request_query,
+            'update': self.request_update,
+            'batch': self.request_batch
+        }
+
+        # Commands allowed inside a batch
+        self.BATCH_COMMANDS = ('query',)
+
+        # Users logged in and sessions, possibly shared with other processes
+        self.logins = logins if logins is not None else LoginTable()
+
+        # Connected clients, by connection (see current_client)
+        self.clients = ClientRegistry(self.logins)
+
+        # Sessions that can be resumed on a new connection, by session token. Each session is a
+        # tuple of (username, name, role, expiry time).
+        self.sessions = self.logins.sessions
+        self.sessions_lock = self.logins.lock
+
+        # Flag to signal the threads that the server is going down, and event set at the same time
+        self.system_on = True
+        self.stopped = threading.Event()
+
+        # Lock
+        self.lock = threading.Lock()
+
+        # Statistics displayed in the main window
+        self.statistics = StatisticsCollector()
+
+        # Preset compression dictionary, built from the names found in the database
+        self.compression_dictionary = self.build_compression_dictionary()
+
+        # Threads executing pipelined requests
+        self.pipeline_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.PIPELINE_WORKERS,
+            thread_name_prefix='pipeline'
+        )
+
+        self.main_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if reuse_port or events is not None:
+            self.main_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.main_socket.bind((self.SERVER_ADDRESS, self.SERVER_PORT))
+
+        # Whether this is a worker process of the multi-process mode
+        self.worker = events is not None
+        self.events = events
+
+        # Background thread that listens and responses to discovery requests from remote clients
+        self.thread_discovery = threading.Thread(target=self.request_discovery, daemon=True)
+
+        # Thread maintaining the main window (in the parent process only, in the multi-process mode)
+        self.main_window = None if self.worker else widget.ServerWindow(self.exit, self.statistics.collect)
+
+
+    # ----------- Utility methods ----------
+
+    def update_request_statistics(self, conn, command):
+        """Update the statistics in the main window (including adding new row in the
+        Activities table and increasing Requests Made). Only counts the request: the main window
+        displays it later.
+
+        Parameters
+        ----------
+        conn : socket.socket
+            The socket connected to the client. Needed this to get the client's address.
+        command : str
+            The command requested by the client.
+        """
+
+        # Keepalive requests are not worth a row
+        if command == 'ping':
+            return
+
+        try:
+            address = conn.getpeername()[0]
+        except OSError:
+            address = ''
+        self.statistics.count_request(address, command)
+
+    def update_request_times(self, queue_wait, execution_time):
+        """Update the average time requests wait for a worker and take to execute in the main
+        window
+
+        Parameters
+        ----------
+        queue_wait : float
+            Time the last request waited, in seconds
+        execution_time : float
+            Time the last request took to execute, in seconds
+        """
+
+        self.statistics.count_request_times(queue_wait, execution_time)
+
+    def update_admission_statistics(self, queue_length, average_wait):
+        """Update the number of clients waiting for admission and their average waiting time in the
+        main window
+
+        Parameters
+        ----------
+        queue_length : int
+
+        average_wait : float
+            In seconds
+        """
+
+        self.statistics.set_admission(queue_length, average_wait)
+
+    def register_client(self, connection, ticket):
+        """Register a client admitted by the admission controller, once it has been sent the connect
+        response
+
+        Parameters
+        ----------
+        connection : app.Connection
+
+        ticket : concurrent.futures.Future
+            The admission ticket of the client, given back when it leaves (see remove_client)
+        """
+
+        self.clients.add(connection, ticket)
+
+    def wait_for_admission(self, ticket) -> bool:
+        """Wait for a client to be admitted, for at most ADMISSION_MAX_WAIT seconds
+
+        Returns
+        -------
+        bool
+            True if the client is admitted, False if it has to be rejected
+        """
+
+        try:
+            return ticket.result(timeout=self.ADMISSION_MAX_WAIT)
+        except concurrent.futures.TimeoutError:
+            return not self.admission.withdraw(ticket)
+
+    def reject_response(self) -> bytes:
+        """The response to a connect request of a client that could not be admitted, containing
+        the number of seconds after which it may try again
+        """
+
+        return util.package('001', self.STATUS_MESSAGES['001'], str(self.admission.retry_after()))
+
+    def current_client(self) -> app.Connection:
+        """The connection of the client whose request is being handled, its key in self.clients
+        """
+
+        return current_connection.get()
+
+    def current_thread_has_user_logged_in(self):
+        """Check if user has logged in on the connection of the current request
+
+        Returns
+        -------
+        bool
+        """
+
+        return self.clients[self.current_client()].username is not None
+
+    def create_session(self, username, name, role) -> str:
+        """Record a new session (expired sessions are forgotten by the reaper, see reap)
+
+        Parameters
+        ----------
+        username : str
+
+        name : str
+
+        role : str
+            'admin' or 'ordinary'
+
+        Returns
+        -------
+        str
+            The session token
+        """
+
+        token = secrets.token_urlsafe(16)
+        now = datetime.datetime.now()
+        with self.sessions_lock:
+            self.sessions[token] = (username, name, role, now + self.SESSION_LIFETIME)
+        return token
+
+    def expire_sessions(self):
+        """Forget the expired sessions
+        """
+
+        now = datetime.datetime.now()
+        with self.sessions_lock:
+            for t in [t for t, v in self.sessions.items() if v[3] < now]:
+                del self.sessions[t]
+
+    def find_session(self, token):
+        """Look up a session and extend its lifetime
+
+        Parameters
+        ----------
+        token : str
+
+        Returns
+        -------
+        tuple
+            A tuple of (username, name, role), None if there is no such session or it expired.
+        """
+
+        now = datetime.datetime.now()
+        with self.sessions_lock:
+            session = self.sessions.get(token)
+            if session is None:
+                return None
+            if session[3] < now:
+                del self.sessions[token]
+                return None
+            self.sessions[token] = session[:3] + (now + self.SESSION_LIFETIME,)
+            return session[:3]
+
+    def end_sessions(self, username):
+        """Forget the sessions of a user
+
+        Parameters
+        ----------
+        username : str
+        """
+
+        with self.sessions_lock:
+            for t in [t for t, v in self.sessions.items() if v[0] == username]:
+                del self.sessions[t]
+
+    def build_compression_dictionary(self):
+        """Build the preset compression dictionary from the database
+
+        Returns
+        -------
+        bytes
+            The dictionary, None if the database cannot be read.
+        """
+
+        try:
+            with database.Database(self.DATABASE_PATH, read_only=True) as db:
+                return db.compression_dictionary().encode()
+        except Exception:
+            return None
+
+    # ----------- Starting and exiting methods ----------
+
+    def prepare_to_serve(self):
+        """Create the admission controller, the rate limiter, the database connection pool and the
+        autocompletion index, start the database writer and the reaper, and start the discovery
+        thread and the main window (in the parent process only, in the multi-process mode)
+        """
+
+        self.admission = AdmissionController(
+            self.MAX_CLIENT_THREADS, self.ADMISSION_QUEUE_SIZE, self.update_admission_statistics
+        )
+        self.writer = DatabaseWriter(self.DATABASE_PATH, self.WRITE_BATCH_DELAY, self.WRITE_BATCH_SIZE)
+        self.writer.start()
+        self.databases = database.ConnectionPool(self.DATABASE_PATH, self.DATABASE_POOL_SIZE)
+        with self.databases.get() as db:
+            self.city_version = db.city_version()
+            self.city_index = CityIndex(db.list_cities())
+        self.statistics.set_index_size(self.city_index.size)
+        self.rate_limiter = RateLimiter(self.RATE_LIMITS)
+        threading.Thread(target=self.reap, name='reaper', daemon=True).start()
+        if self.worker:
+            threading.Thread(target=self.report_statistics, daemon=True).start()
+        else:
+            self.thread_discovery.start()
+            self.main_window.start()
+
+    def report_statistics(self):
+        """Target function for the thread sending the statistics of a worker process to the parent
+        process, a few times per second (see apply_worker_events)
+        """
+
+        while not self.stopped.wait(0.25):
+            self.events.put((
+                os.getpid(),
+                self.statistics.totals(),
+                self.statistics.admission,
+                self.statistics.take_activities()
+            ))
+
+    def forget_worker(self, process):
+        """Target function for the threads logging out the users of a worker process that exits
+        before the server is closed, e.g. after a crash
+
+        Parameters
+        ----------
+        process : multiprocessing.Process
+
+        """
+
+        process.join()
+        if self.stopped.is_set():
+            return
+        try:
+            self.logins.forget_process(process.pid)
+        except (OSError, EOFError):
+            # The manager keeping the table is gone: the parent process is exiting
+            pass
+
+    def apply_worker_events(self, events):
+        """Target function for the thread receiving the statistics sent by the worker processes
+        (see report_statistics)
+
+        Parameters
+        ----------
+        events : multiprocessing.Queue
+
+        """
+
+        while True:
+            self.statistics.merge(*events.get())
+
+    def run(self):
+        """Start the server
+        """
+
+        self.prepare_to_serve()
+
+        with self.main_socket:
+            self.main_socket.listen()
+            # Checking system_on regularly, in case the connection made by wake lands on another
+            # process listening on the same port (multi-process mode)
+            self.main_socket.settimeout(1.0)
+            while self.system_on:
+                try:    
+                    # Accept connection from clients
+                    conn, _ = self.main_socket.accept()
+                except socket.timeout:
+                    continue
+                except Exception:
+                    with self.lock:
+                        self.system_on = False
+                    break
+
+                # The connection made by wake
+                if not self.system_on:
+                    conn.close()
+                    break
+
+                # Start a thread for each client, waiting for its admission first
+                thread = threading.Thread(target=self.serve_connection, args=(conn,))
+                thread.start()
+
+        self.drain()
+
+    def exit(self):
+        """Close the server
+        """
+
+        self.main_window.root.destroy()
+        self.stop()
+
+    def stop(self):
+        """Stop accepting connections, and close the connected ones once their requests are done
+        (see drain)
+        """
+
+        with self.lock:
+            self.system_on = False
+        self.stopped.set()
+        self.wake()
+
+    def wake(self):
+        """Wake up the thread accepting connections, once system_on is False, by connecting to
+        the listening socket (shutting it down only wakes accept up on Linux)
+        """
+
+        try:
+            socket.create_connection(self.main_socket.getsockname(), timeout=1.0).close()
+        except OSError:
+            pass
+
+    def drain(self):
+        """Close all the connections, once the server stopped accepting new ones. The clients are
+        sent a goaway message as soon as none of their requests is in flight (read, and waiting to
+        be executed or being executed), and their connection is closed. The connections not closed
+        by the client GOAWAY_TIMEOUT seconds later are aborted, and so are the ones still busy
+        after SHUTDOWN_DEADLINE seconds.
+        """
+
+        # Clients waiting for admission are rejected, and no more are admitted
+        self.admission.close()
+
+        for client in self.clients.close():
+            self.go_away(client.connection)
+        deadline = time.monotonic() + self.SHUTDOWN_DEADLINE
+        while not self.clients.wait_until_empty(0.1):
+            now = time.monotonic()
+            if now > deadline:
+                for connection in self.clients.connections():
+                    connection.abort()
+
+                # Give the connections a moment to be closed
+                self.clients.wait_until_empty(1.0)
+                return
+
+            # Idle clients (a user not touching the client) only read the goaway message on their
+            # next request, and would otherwise keep the server until the deadline
+            for client in self.clients.let_go_before(now - self.GOAWAY_TIMEOUT):
+                try:
+                    client.connection.abort()
+                except OSError:
+                    pass
+
+    def go_away(self, connection: app.Connection):
+        """Tell a client that the server is shutting down, and close its connection
+
+        Parameters
+        ----------
+        connection : app.Connection
+
+        """
+
+        try:
+            connection.send('goaway', '', '')
+            connection.close()
+        except (app.ConnectionError, OSError):
+            pass
+
+
+    def reap(self):
+        """Target function for the thread closing the connections idle for more than IDLE_TIMEOUT
+        seconds, forgetting the expired sessions and the unused rate limit buckets, and reloading
+        the autocompletion index when needed. The closed connections are then noticed and
+        forgotten as usual by their engine (see remove_client).
+        """
+
+        while not self.stopped.wait(self.REAP_INTERVAL):
+            for client in self.clients.idle_clients(time.monotonic() - self.IDLE_TIMEOUT):
+                try:
+                    client.connection.abort()
+                except OSError:
+                    pass
+            self.expire_sessions()
+            self.rate_limiter.forget_full()
+            try:
+                self.reload_city_index()
+            except sqlite3.Error:
+                # Tried again at the next interval
+                pass
+
+    def reload_city_index(self):
+        """Rebuild the autocompletion index if the city table was modified by another process
+        since it was built: the cities added by this process are in the index already, and counted
+        in city_version (see request_update), but not the ones added by the other processes in the
+        multi-process mode
+        """
+
+        with self.databases.get() as db:
+            # Read before the cities, so that a modification made in between is not missed
+            version = db.city_version()
+            with self.lock:
+                if version == self.city_version:
+                    return
+            cities = db.list_cities()
+        city_index = CityIndex(cities)
+        with self.lock:
+            self.city_index = city_index
+            self.city_version = version
+        self.statistics.set_index_size(city_index.size)
+
+
+    # ---------- Slave method used by threads ----------
+
+    def serve_connection(self, conn: socket.socket):
+        """Target function for the threads started for each client: do the connect handshake,
+        then serve the client if it is accepted
+
+        Parameters
+        ----------
+        conn : socket.socket
+            The newly created connection to the client
+        """
+
+        # Accept the client for communication or not
+        connection = self.request_connect(conn)
+        if connection is None:
+            return
+
+        self.statistics.count_connections(1)
+        self.slave(connection)
+
+    def slave(self, connection: app.Connection):
+        """Target function for threads that communicate with client
+        
+        Parameters
+        ----------
+        connection : app.Connection
+            The connection to the client, established during the connect handshake
+        """
+        
+        current_connection.set(connection)
+
+        try:
+            with connection.sock:
+                while True:
+                    # Extract request message
+                    command, command_type, data, request_id, flags = connection.receive()
+
+                    # Update the request statistics
+                    self.update_request_statistics(connection.sock, command)
+
+                    client = self.clients.begin_request(connection)
+                    if client is None:
+                        # Let go: the server is shutting down
+                        continue
+
+                    # Pipelined requests are answered out of order, as soon as they are done
+                    if request_id is not None and command in self.PIPELINED_COMMANDS:
+                        self.pipeline_executor.submit(
+                            contextvars.copy_context().run,
+                            self.do_pipelined_request, client, command, command_type, data, request_id, flags
+                        )
+                        continue
+
+                    # Do the request and response
+                    self.do_request(client, command, command_type, data, request_id, flags)
+
+        # Connection to client is terminated    
+        except app.ConnectionError:
+            pass
+        finally:
+            # Even if the thread failed, so that the client does not keep its admission slot
+            self.remove_client()
+
+    def remove_client(self):
+        """Forget the client of the current connection, once it is terminated
+        """
+
+        client, username = self.clients.remove(self.current_client())
+        self.statistics.count_connections(-1)
+        if username is not None:
+            self.statistics.count_users(-1)
+
+        self.admission.leave(client.ticket)
+
+    def do_request(self, client, command, command_type, data, request_id=None, flags=0):
+        """Execute a request and send the response back to the client
+
+        Parameters
+        ----------
+        client : ConnectedClient
+            The client, with the request counted as in flight (see ClientRegistry.begin_request)
+        command : str
+
+        command_type : str
+
+        data : str
+
+        request_id : int
+            ID of the request, echoed in the response (None if the client did not send one)
+        flags : int
+            Flags of the request frame. Queries flagged with util.FLAG_BINARY_ROWS are answered
+            with binary rows, if the client accepted them during the handshake.
+        """
+
+        connection = client.connection
+        try:
+            wait = self.limit_rate(client, command, data)
+            if wait > 0:
+                connection.send('003', self.STATUS_MESSAGES['003'], str(math.ceil(wait)), request_id)
+                return
+
+            try:
+                status_code, response_data = self.REQUESTS[command](command_type, data)
+            except (ValueError, IndexError, KeyError, sqlite3.Error, database.DatabaseConnectionError):
+                # A malformed request, or the database failing: the client is answered with an
+                # error, and its connection is served as usual
+                status_code, response_data = '002', ''
+            if isinstance(response_data, str):
+                connection.send(status_code, self.STATUS_MESSAGES[status_code], response_data, request_id)
+                return
+
+            schema = None
+            if command == 'query' and flags & util.FLAG_BINARY_ROWS and 'binrows' in connection.features:
+                schema = self.ROW_SCHEMAS[command_type]
+            self.send_rows(connection, status_code, response_data, request_id, schema)
+        finally:
+            # Once the server is shutting down, clients are let go after their last request
+            if self.clients.end_request(client):
+                self.go_away(connection)
+
+    def limit_rate(self, client, command, data) -> float:
+        """Count a request against the rate limits of a client (see RATE_LIMITS)
+
+        Parameters
+        ----------
+        client : ConnectedClient
+
+        command : str
+
+        data : str
+            The data of the request
+
+        Returns
+        -------
+        float
+            0 if the request is accepted, otherwise the number of seconds after which it would be
+        """
+
+        cost = 1
+        if command == 'batch':
+            command = 'query'
+            try:
+                # Larger batches are rejected by request_batch without executing them
+                n = int(data.split('\n', 1)[0])
+                if n <= self.MAX_BATCH_SIZE:
+                    cost = max(1, n)
+            except ValueError:
+                pass
+
+        keys = [('address', client.address)]
+        if client.username is not None:
+            keys.append(('username', client.username))
+        return self.rate_limiter.acquire(keys, command, cost)
+
+    def send_rows(self, connection, status_code, rows, request_id=None, schema=None):
+        """Send the rows of a query result. If the client accepted streaming, the rows are sent
+        in chunks as they come out of the database cursor, followed by a terminator frame
+        containing the number of rows (and the continuation token of paginated results).
+        Otherwise, they are sent in one response (see util.format_result).
+
+        With a schema, the rows are encoded in binary (see util.encode_rows): each chunk of a
+        streamed response is a block of rows, and a response sent at once contains the header
+        line followed by a single block.
+
+        Parameters
+        ----------
+        connection : app.Connection
+
+        status_code : str
+
+        rows : iterable
+            An iterable of tuples.
+        request_id : int
+
+        schema : str
+            Column types of the rows, None to send them in text
+
+        """
+
+        status_message = self.STATUS_MESSAGES[status_code]
+        if 'stream' not in connection.features:
+            try:
+                if schema is None:
+                    data, flags = util.format_result(rows), 0
+                else:
+                    row_list = list(rows)
+                    header = util.result_header(rows, len(row_list))
+                    data = header.encode() + b'\n' + util.encode_rows(row_list, schema)
+                    flags = util.FLAG_BINARY_ROWS
+            except (sqlite3.Error, ValueError):
+                # A value that cannot be encoded (see util.encode_rows) fails the query as well
+                connection.send('002', self.STATUS_MESSAGES['002'], '', request_id)
+                return
+            connection.send(status_code, status_message, data, request_id, flags)
+            return
+
+        remaining = iter(rows)
+        num_row = 0
+        try:
+            while True:
+                chunk = list(itertools.islice(remaining, self.STREAM_CHUNK_ROWS))
+                if not chunk:
+                    break
+                if schema is None:
+                    connection.send(status_code, status_message, util.format_rows(chunk), request_id, util.FLAG_MORE)
+                else:
+                    connection.send(
+                        status_code, status_message, util.encode_rows(chunk, schema), request_id,
+                        util.FLAG_MORE | util.FLAG_BINARY_ROWS
+                    )
+                num_row += len(chunk)
+        except (sqlite3.Error, ValueError):
+            connection.send('002', self.STATUS_MESSAGES['002'], '', request_id)
+            return
+        connection.send(status_code, status_message, util.result_header(rows, num_row), request_id)
+
+    def do_pipelined_request(self, *args):
+        """Target function for the threads executing pipelined requests. Same parameters as do_request.
+        """
+
+        try:
+            self.do_request(*args)
+        except app.ConnectionError:
+            # The slave thread of the connection takes care of it
+            pass
+        except Exception:
+            self.fail_request(args[0].connection)
+
+    def fail_request(self, connection):
+        """Close the connection of a request that failed unexpectedly in a worker thread (malformed
+        requests are answered by do_request), instead of leaving the client waiting for a response
+        that never comes: the same as when the thread reading the connection fails. The error is
+        printed, rather than lost in the worker's future.
+
+        Parameters
+        ----------
+        connection : app.Connection
+
+        """
+
+        traceback.print_exc()
+        try:
+            connection.abort()
+        except OSError:
+            pass
+
+
+    # ---------- Methods handling requests from clients ----------
+
+    def test(self, command_type, data):
+        return ('000', 'vl' * 1000)
+
+    def request_discovery(self):
+        """This function listens for remote client discovery message and responses
+        with the server address"""
+
+        # Create the UDP discovery socket
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(('', self.DISCOVERY_PORT))
+
+        while True:
+            # Listen for requests
+            message, client_connection = s.recvfrom(1024)
+            # util.print_message(message)
+
+            # Verify the discovery message
+            command, *_ = util.extract(message)
+            if command == 'discover':
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                s.sendto(
+                    util.package('000', '', self.SERVER_ADDRESS),
+                    ('255.255.255.255', client_connection[1])
+                )
+
+    def request_connect(self, conn: socket.socket):
+        """Verify connection request from clients. In particular, approve or reject the
+        client connection based on the number of clients currently serving.
+
+        Clients coming when the server is full wait for another client to leave, for at most
+        ADMISSION_MAX_WAIT seconds (see AdmissionController). Clients rejected are told after how
+        many seconds they may try again.
+
+        The data field of the connect request is a comma-separated list of the optional features
+        the client wants to use (see FEATURES), and the response contains the ones accepted by the
+        server. Clients not asking for the binary framing keep using the text framing, and the other
+        features require the binary framing. The handshake itself is always in text framing.
+
+        Clients may also send their protocol version (version=<n>) and the size of the largest
+        message they accept (maxframe=<bytes>). The server answers with the lowest of both versions
+        and of both sizes, and neither side sends messages larger than that.
+
+        With zlib compression, the client may offer the ID of the preset dictionary it holds
+        (zdict=<ID>). The server answers with the ID of its own dictionary, which is used only if
+        both IDs match.
+
+        Parameters
+        ----------
+        conn : socket.socket
+            The newly created connection to the client
+
+        Returns
+        -------
+        app.Connection
+            The connection if it is approved, set to the accepted features.
+        None
+            If the connection is rejected, after closing it.
+        """
+
+        # Setting limited time for the client to send connect request
+        conn.settimeout(1.0)
+
+        try:
+            # Verify the connect message
+            reader = self.create_reader(conn)
+            command, _, _, data = util.extract(reader.read())
+            if command != 'connect':
+                conn.close()
+                raise app.ConnectionError('Not a connect request')
+            connection = app.Connection(conn, reader)
+            accepted = self.negotiate(connection, data)
 
-        # Dictionary translating status codes to status messages
-        self.STATUS_MESSAGES = {
-            '000': 'OK',
-            '001': 'Reached maximum client',
-            '100': 'Username or password not found',
-            '101': 'Already logged in',
-            '102': 'Username already existed',
-            '103': 'Already logged out',
-            '104': 'Not admin',
-            '300': 'Permission denied',
-            '301': 'Could not add city',
-            '302': 'Could not update weather information'
-        }
+            # Reset the timeout for future use
+            conn.settimeout(None)
+
+            # Wait for enough space for the client
+            ticket = self.admission.enter()
+            if ticket is None or not self.wait_for_admission(ticket):
+                conn.sendall(self.reject_response())
+                raise app.ConnectionError('Max client reached')
+
+            try:
+                conn.sendall(util.package('000', self.STATUS_MESSAGES['000'], util.format_features(accepted)))
+            except OSError:
+                self.admission.leave(ticket)
+                raise
+            self.register_client(connection, ticket)
+            return connection
+
+        # Catch any exception, including socket.timeout
+        except Exception:
+            conn.close()
+            return None
+
+    def negotiate(self, connection, data):
+        """Set up a new connection with the features requested in a connect message (see
+        request_connect)
+
+        Parameters
+        ----------
+        connection : app.Connection
+            The connection, before any feature is enabled
+        data : str
+            Data field of the connect message
+
+        Returns
+        -------
+        dict
+            The accepted features, to send back to the client
+
+        Raises
+        ------
+        ValueError
+            If the data field is malformed.
+        """
+
+        reader = connection.reader
+        requested = util.parse_features(data)
+        accepted = {}
+        if 'binary' in requested:
+            reader.framing = 'binary'
+            accepted = {f: '' for f in self.FEATURES if f in requested}
+        connection.features = accepted
+
+        if 'version' in requested:
+            accepted['version'] = str(min(int(requested['version']), util.PROTOCOL_VERSION))
+        else:
+            # Clients older than the protocol version send none, and size their messages one byte
+            # short at digit boundaries
+            reader.legacy_sizes = True
+        if 'maxframe' in requested:
+            max_frame_size = min(int(requested['maxframe']), self.MAX_FRAME_SIZE)
+            accepted['maxframe'] = str(max_frame_size)
+            connection.max_frame_size = max_frame_size
+            reader.max_frame_size = max_frame_size
+
+        if 'zlib' in accepted:
+            dictionary = None
+            if 'zdict' in accepted and self.compression_dictionary:
+                accepted['zdict'] = util.dictionary_id(self.compression_dictionary)
+                if requested['zdict'] == accepted['zdict']:
+                    dictionary = self.compression_dictionary
+            else:
+                accepted.pop('zdict', None)
+            connection.compression = util.Compression(
+                self.COMPRESSION_THRESHOLD, dictionary, max_size=reader.max_frame_size
+            )
+        else:
+            accepted.pop('zdict', None)
+        return accepted
+
+    def request_login(self, command_type, request_data):
+        """Handle the login command
+
+        Parameters
+        ----------
+        command_type : str
+            
+        data : str
+        
+        Returns
+        -------
+        tuple
+            A tuple of (status_code, response_data)
+        """
+
+        status_code = ''
+        response_data = ''
+
+        # An optional second line lists login options: 'session' asks for a session token
+        credentials, _, options = request_data.partition('\n')
+        username, password = credentials.split(',', 1)
+        if self.clients.logged_in(username):
+            return ('101', '')
+
+        with self.databases.get() as db:
+            admin = False
+            if command_type == 'admin':
+                admin = True
+                if len(username) != 3 or not username.isnumeric():
+                    return ('104', '')
+
+            user_info = db.authenticate(username, password)
+
+            if len(user_info) == 1:
+                # Record user login time, unless the user logged in on another connection meanwhile
+                role = 'admin' if admin else 'ordinary'
+                if not self.clients.log_in(self.clients[self.current_client()], username, role):
+                    return ('101', '')
+
+                # Increase active users
+                self.statistics.count_users(1)
+                
+                response_data = f'{username},{user_info[0][1]}\n'
+                if 'session' in options.split(','):
+                    response_data += self.create_session(username, user_info[0][1], role)
+                status_code = '000'
+            else:
+                status_code = '100'
+        return (status_code, response_data)
+
+    def request_signup(self, command_type, request_data):
+        """Handle the signup command
+
+        Parameters
+        ----------
+        command_type : str
+            
+        request_data : str
+            
+
+        Returns
+        -------
+        tuple
+            A tuple of (status_code, response_data)
+        """
+
+        name, username, password = request_data.split(',', 2)
+        done = self.writer.submit(database.Database.sign_up, username, password, name)
+        try:
+            if not done.result(timeout=self.WRITE_TIMEOUT):
+                return ('102', '')
+        except (sqlite3.Error, concurrent.futures.TimeoutError):
+            # The transaction failed, e.g. the database is locked by the writer of another process
+            return ('002', '')
+        return ('000', '')
+
+    def request_logout(self, command_type, request_data):
+        """Handle the logout command
+
+        Parameters
+        ----------
+        command_type : str
+            
+        request_data : str
+            
+
+        Returns
+        -------
+        tuple
+            A tuple of (status_code, response_data)
+        """
+
+        # Remove the user info associated with the connection
+        username = self.clients.log_out(self.clients[self.current_client()])
+
+        # User is not currently logged in
+        if username is None:
+            return ('103', '')
+        else:
+            # Remove the user's sessions
+            self.end_sessions(username)
+            
+            # Decrease active users
+            self.statistics.count_users(-1)
+            return ('000', '')
+
+    def request_resume(self, command_type, request_data):
+        """Handle the resume command: log in again with the token of a session started on a
+        previous connection, without authenticating the user against the database
+
+        Parameters
+        ----------
+        command_type : str
+
+        request_data : str
+            The session token
+
+        Returns
+        -------
+        tuple
+            A tuple of (status_code, response_data)
+        """
+
+        if self.current_thread_has_user_logged_in():
+            return ('101', '')
+
+        # The previous connection of the user may not be known to be closed yet, so unlike login,
+        # the user is not required to be logged out everywhere
+        session = self.find_session(request_data)
+        if session is None:
+            return ('105', '')
+
+        username, name, role = session
+        self.clients.log_in(self.clients[self.current_client()], username, role, exclusive=False)
+        self.statistics.count_users(1)
+        return ('000', f'{username},{name}\n{request_data}')
+
+    def request_ping(self, command_type, request_data):
+        """Handle the ping command, used by clients to keep their connection open
+
+        Parameters
+        ----------
+        command_type : str
+
+        request_data : str
+            Echoed back
+
+        Returns
+        -------
+        tuple
+            A tuple of (status_code, response_data)
+        """
+
+        return ('000', request_data)
+
+    def request_query(self, command_type, request_data, db=None):
+        """Handle the query command
+
+        Parameters
+        ----------
+        command_type : str
+            
+        request_data : str
+            
+        db : database.Database
+            An already checked out database to use, one is checked out of the pool if None
+
+        Returns
+        -------
+        tuple
+            A tuple of (status_code, response_data). For city, weather and forecast queries,
+            response_data is an iterable of rows, formatted by send_rows.
+        """
+
+        if command_type == 'autocomplete':
+            return self.complete_city(request_data)
+
+        if db is None:
+            with self.databases.get() as db:
+                return self.request_query(command_type, request_data, db)
+
+        status_code = '002'
+        response_data = ''
+        if command_type in ('city', 'weather'):
+            # The first line of data contains the keyword to search (city) or the date in YYYY-MM-DD
+            # format (weather), the optional second line the page size and continuation token
+            try:
+                value, limit, after = self.parse_page_request(request_data)
+            except ValueError:
+                return ('002', '')
+
+            if command_type == 'city':
+                # Cities are sorted by relevance: pages are continued from their offset
+                rows = db.search_city(value, lazy=True, limit=limit, after=after, top=self.SEARCH_LIMIT)
+                offset = after or 0
+            else:
+                rows = db.query_weather_by_date(value, lazy=True, limit=limit, after=after)
+                offset = None
+            response_data = rows if limit is None else util.Page(rows, limit - 1, offset)
+            status_code = '000'
+        
+        elif command_type == 'forecast':
+            # data contains the city id
+            if not request_data.isdecimal():
+                return ('002', '')
+            response_data = db.forecast(int(request_data))
+            status_code = '000'
+
+        elif command_type == 'dictionary':
+            # The preset compression dictionary, for clients to use on their next connections
+            if self.compression_dictionary:
+                response_data = self.compression_dictionary.decode()
+            status_code = '000'
+    
+        return (status_code, response_data)
+
+    def complete_city(self, request_data):
+        """Handle the autocomplete query, from memory (see CityIndex)
+
+        Parameters
+        ----------
+        request_data : str
+            The beginning of a city name, and an optional second line with the maximum number of
+            cities to suggest (capped by AUTOCOMPLETE_LIMIT)
+
+        Returns
+        -------
+        tuple
+            A tuple of (status_code, response_data), response_data being a list of rows.
+        """
+
+        prefix, _, n = request_data.partition('\n')
+        if n and not n.isdecimal():
+            return ('002', '')
+        n = min(int(n), self.AUTOCOMPLETE_LIMIT) if n else self.AUTOCOMPLETE_LIMIT
+        return ('000', self.city_index.complete(prefix, n))
+
+    def parse_page_request(self, request_data):
+        """Parse the data field of a query that can be paginated:
+        <value>[\n<limit>,<continuation token>]
+
+        Parameters
+        ----------
+        request_data : str
+
+        Returns
+        -------
+        tuple
+            A tuple of (value, limit, after), where limit is the number of rows to fetch (one more
+            than the page size, to know if there is a next page) and after the last key of the
+            previous page. Both are None if there is no pagination.
+
+        Raises
+        ------
+        ValueError
+            If the paging line is malformed.
+        """
+
+        value, _, paging = request_data.partition('\n')
+        if not paging:
+            return value, None, None
+
+        limit, _, token = paging.partition(',')
+        limit = min(int(limit), self.MAX_PAGE_SIZE)
+        if limit <= 0:
+            raise ValueError('Invalid limit')
+        after = util.decode_token(token) if token else None
+        return value, limit + 1, after
+
+    def request_update(self, command_type, request_data):
+        """Handle the update command
+
+        Parameters
+        ----------
+        command_type : str
+            
+        request_data : str
+            
+
+        Returns
+        -------
+        tuple
+            A tuple of (status_code, response_data)
+        """
+
+        # Check user's priviledge
+        if self.clients[self.current_client()].role != 'admin':
+            return ('300', '')
+
+        # The modification is committed by the writer thread, together with the ones of other clients
+        if command_type == 'city':
+            s = request_data.split(',', 4)
+            s[3] = float(s[3])
+            s[4] = float(s[4])
+            done = self.writer.submit(database.Database.add_city, tuple(s))
+            error_code = '301'
+        elif command_type == 'weather':
+            city_id, date, rest = request_data.split(',', 2)
+            if not util.validate_iso_date_format(date):
+                return ('302', '')
+            done = self.writer.submit(database.Database.update_weather, city_id, date, tuple(rest.split(',')))
+            error_code = '302'
+        else:
+            return ('002', '')
+
+        try:
+            if not done.result(timeout=self.WRITE_TIMEOUT):
+                return (error_code, '')
+        except (sqlite3.Error, concurrent.futures.TimeoutError):
+            return (error_code, '')
+
+        if command_type == 'city':
+            with self.databases.get() as db:
+                self.city_index.add(db.list_cities(int(s[0]))[0])
+            # The city added one to the version of the city table, and is already in the index
+            with self.lock:
+                self.city_version += 1
+            self.statistics.set_index_size(self.city_index.size)
+        return ('000', '')
+
+    def request_batch(self, command_type, request_data):
+        """Handle the batch command: execute several sub-requests, sharing one database connection,
+        and return all the results in one response
+
+        Parameters
+        ----------
+        command_type : str
+            Unused
+        request_data : str
+            Line 1 is the number n of sub-requests, each of the next n lines is a sub-request
+            formatted as <command>,<type>,<data>
+
+        Returns
+        -------
+        tuple
+            A tuple of (status_code, response_data). The response data starts with a line
+            containing n, followed by, for each sub-request, a line <status code>,<size>
+            and the sub-request's response data (size is its number of characters).
+        """
+
+        try:
+            num_request, rest = request_data.split('\n', 1)
+            sub_requests = [line.split(',', 2) for line in rest.splitlines()]
+            if int(num_request) != len(sub_requests) or any(len(r) != 3 for r in sub_requests):
+                return ('002', '')
+            if len(sub_requests) > self.MAX_BATCH_SIZE:
+                return ('002', '')
+        except ValueError:
+            return ('002', '')
+
+        results = [str(len(sub_requests)) + '\n']
+        with self.databases.get() as db:
+            for command, sub_type, sub_data in sub_requests:
+                status_code, response_data = '002', ''
+                if command in self.BATCH_COMMANDS:
+                    try:
+                        status_code, response_data = self.REQUESTS[command](sub_type, sub_data, db)
+                        if not isinstance(response_data, str):
+                            response_data = util.format_result(response_data)
+                    except ValueError:
+                        pass
+                if status_code not in self.STATUS_MESSAGES:
+                    status_code, response_data = '002', ''
+
+                results.append(f'{status_code},{len(response_data)}\n')
+                results.append(response_data)
+
+        return ('000', ''.join(results))
+
+
+class AsyncServer(Server):
+    """Server serving all the clients from a single asyncio event loop, instead of a thread per
+    client. Requests are handled by the same methods as Server, in a pool of threads since they
+    block on SQLite.
+    """
+
+    def __init__(self, reuse_port=False, events=None, logins=None):
+        super().__init__(reuse_port, events, logins)
+
+        # Idle connections cost no thread in this engine
+        self.MAX_CLIENT_THREADS = 10000
+
+        # Threads executing the requests
+        self.REQUEST_WORKERS = 16
+
+        # Event loop serving the clients, and event set to stop it (see wake)
+        self.loop = None
+        self.stopping = None
+        self.request_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.REQUEST_WORKERS,
+            thread_name_prefix='request'
+        )
+
+    # ----------- Starting and exiting methods ----------
+
+    def run(self):
+        """Start the server
+        """
+
+        self.prepare_to_serve()
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        """Accept connections until the server is closed
+        """
+
+        self.loop = asyncio.get_running_loop()
+        self.loop.set_default_executor(self.request_executor)
+        self.stopping = asyncio.Event()
+        server = await asyncio.start_server(self.serve_client, sock=self.main_socket, backlog=socket.SOMAXCONN)
+        async with server:
+            if self.system_on:
+                await self.stopping.wait()
+
+            server.close()
+            await asyncio.to_thread(self.drain)
+
+    def wake(self):
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.stopping.set)
+            except RuntimeError:
+                # The loop is closed: the server is stopped already
+                pass
+
+    # ---------- Coroutines serving the clients ----------
+
+    async def serve_client(self, stream_reader: asyncio.StreamReader, stream_writer: asyncio.StreamWriter):
+        """Serve a client, from the connect handshake to the end of the connection. Same as
+        Server.slave.
+
+        Parameters
+        ----------
+        stream_reader : asyncio.StreamReader
 
-        # Dictionary translating from command to the corresponding handle methods
-        self.REQUESTS = {
-            'login': self.request_login,
-            'signup': self.request_signup,
-            'logout': self.request_logout,
-            'query': self.request_query,
-            'update': self.request_update
-        }
+        stream_writer : asyncio.StreamWriter
 
-        # List of clients
-        self.clients = dict()
+        """
 
-        # Flag to signal the threads that the server is going down
-        self.system_on = True
+        connection = await self.request_connect_async(stream_reader, stream_writer)
+        if connection is None:
+            return
 
-        # Lock
-        self.lock = threading.Lock()
+        self.statistics.count_connections(1)
 
-        self.main_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.main_socket.settimeout(1.0)
-        self.main_socket.bind((self.SERVER_ADDRESS, self.SERVER_PORT))
+        # Copied to the threads executing the requests by asyncio.to_thread
+        current_connection.set(connection)
 
-        # Background thread that listens and responses to discovery requests from remote clients
-        self.thread_discovery = threading.Thread(target=self.request_discovery, daemon=True)
+        # Pipelined requests being executed
+        pending = set()
 
-        # Thread maintaining the main window
-        self.main_window = widget.ServerWindow(self.exit)
+        try:
+            while True:
+                command, command_type, data, request_id, flags = await connection.receive()
+                self.update_request_statistics(connection.sock, command)
 
+                client = self.clients.begin_request(connection)
+                if client is None:
+                    # Let go: the server is shutting down
+                    continue
 
-    # ----------- Utility methods ----------
+                # Pipelined requests are answered out of order, as soon as they are done
+                if request_id is not None and command in self.PIPELINED_COMMANDS:
+                    task = asyncio.create_task(asyncio.to_thread(
+                        self.do_pipelined_request, client, command, command_type, data, request_id, flags
+                    ))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                    continue
 
-    def update_request_statistics(self, conn, command):
-        """Update the statistics in the main window (including adding new row in the
-        Activities table and increasing Requests Made)
+                await asyncio.to_thread(self.do_request, client, command, command_type, data, request_id, flags)
+
+        # Connection to client is terminated, or still busy when the server is closed (see drain)
+        except (app.ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            stream_writer.close()
+            self.remove_client()
+
+    async def request_connect_async(self, stream_reader, stream_writer):
+        """Same as Server.request_connect, on an asyncio stream
 
         Parameters
         ----------
-        conn : socket.socket
-            The socket connected to the client. Needed this to get the client's address.
-        command : str
-            The command requested by the client.
-        """
+        stream_reader : asyncio.StreamReader
 
-        if self.main_window.is_alive():
-            with self.lock:
-                self.main_window.f_useractivities.t_activities.add_row((
-                    conn.getpeername()[0],
-                    command,
-                    datetime.datetime.now().isoformat()
-                ))
-                self.main_window.f_stat.inc_requestsmade()
+        stream_writer : asyncio.StreamWriter
 
-    def logged_in(self, username) -> bool:
-        """Check if the username has already logged in (in the current thread or other thread)
 
         Returns
         -------
-        bool
-            True if the client has already logged in, False otherwise
+        app.AsyncConnection
+            The connection if it is approved, set to the accepted features.
+        None
+            If the connection is rejected, after closing it.
         """
-        for v in self.clients.values():
-            if username in v:
-                return True
-        return False
-
-    def current_thread_has_user_logged_in(self):
-        """Check if user has logged in in the current thread
 
-        Returns
-        -------
-        bool
-        """
+        reader = app.AsyncFrameReader(stream_reader, max_frame_size=self.MAX_FRAME_SIZE)
+        connection = app.AsyncConnection(reader, stream_writer)
+        try:
+            # Limited time for the client to send the connect request
+            command, _, _, data = util.extract(await asyncio.wait_for(reader.read(), 1.0))
+            if command != 'connect':
+                raise app.ConnectionError('Not a connect request')
+            accepted = self.negotiate(connection, data)
 
-        return self.clients[threading.current_thread().ident] != ('', '', '')
+            # Wait for enough space for the client
+            ticket = self.admission.enter()
+            if ticket is not None:
+                await asyncio.wait({asyncio.wrap_future(ticket)}, timeout=self.ADMISSION_MAX_WAIT)
+                if not self.admission.withdraw(ticket) and ticket.result():
+                    self.register_client(connection, ticket)
+                    stream_writer.write(util.package('000', self.STATUS_MESSAGES['000'], util.format_features(accepted)))
+                    return connection
 
-    # ----------- Starting and exiting methods ----------
+            stream_writer.write(self.reject_response())
+            await stream_writer.drain()
 
-    def run(self):
-        """Start the server
-        """
+        # Catch any exception, including asyncio.TimeoutError
+        except Exception:
+            pass
+        stream_writer.close()
+        return None
 
-        self.thread_discovery.start()
-        self.main_window.start()
+class PoolServer(Server):
+    """Server reading the requests of all the clients from a single thread (using a selector), and
+    executing them in a fixed pool of worker threads (see WorkerPool). A slow request only holds a
+    worker, and the number of threads does not grow with the number of clients.
 
-        with self.main_socket:
-            self.main_socket.listen()
-            while self.system_on:
-                try:    
-                    # Accept connection from clients
-                    conn, _ = self.main_socket.accept()
+    As in Server, the requests of a connection are executed in order, except pipelined ones: the
+    connection is not read while one of its other requests is being executed.
+    """
 
-                    # Accept the client for communication or not
-                    if not self.request_connect(conn):
-                        continue
-                    
-                    with self.lock:
-                        self.main_window.f_stat.inc_activeconnections()
+    def __init__(self, reuse_port=False, events=None, logins=None):
+        super().__init__(reuse_port, events, logins)
 
-                    # Start a thread for each accepted client
-                    thread = threading.Thread(target=self.slave, args=(conn,))
-                    thread.start()
+        # Idle connections cost no thread in this engine
+        self.MAX_CLIENT_THREADS = 10000
 
-                    # Initialize the user identification associated with the thread
-                    self.clients[thread.ident] = ('', '', '')
+        # Number of worker threads, and number of requests that can wait for one. Once the queue is
+        # full, no more requests are read until a worker is free.
+        self.POOL_WORKERS = 8
+        self.POOL_QUEUE_DEPTH = 64
 
-                except socket.timeout:
-                    continue
-                except Exception:
-                    with self.lock:
-                        self.system_on = False
+        self.selector = selectors.DefaultSelector()
 
-    def exit(self):
-        """Close the server
-        """
+        # Sockets waiting for the connect request, with their frame reader and deadline
+        self.handshakes = dict()
 
-        self.main_window.root.destroy()
-        with self.lock:
-            self.system_on = False
+        # Sockets waiting for their admission, with their connection, accepted features, admission
+        # ticket and deadline. The admitted ones are put in admitted, and the selector woken up.
+        self.admitting = dict()
+        self.admitted = queue.SimpleQueue()
 
+        # Connections whose request is done, to read again. The workers wake up the selector by
+        # writing to wakeup_w.
+        self.done = queue.SimpleQueue()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
 
-    # ---------- Slave method used by threads ----------
+    # ----------- Starting and exiting methods ----------
 
-    def slave(self, conn: socket.socket):
-        """Target function for threads that communicate with client
-        
-        Parameters
-        ----------
-        conn : socket.socket
-            The TCP socket that is communicating with the client
+    def run(self):
+        """Start the server
         """
-        
-        try:
-            with conn:
-                while self.system_on:
-                    # Extract request message
-                    m = self.receive_from(conn)
-                    command, command_type, _, data = util.extract(m)
 
-                    # Update the request statistics
-                    self.update_request_statistics(conn, command)
+        self.prepare_to_serve()
 
-                    # Do the request
-                    t = self.REQUESTS[command](command_type, data)
+        self.pool = WorkerPool(self.POOL_WORKERS, self.POOL_QUEUE_DEPTH, self.update_request_times)
+        with self.main_socket:
+            self.main_socket.listen(socket.SOMAXCONN)
+            self.main_socket.setblocking(False)
+            self.selector.register(self.main_socket, selectors.EVENT_READ)
+            self.selector.register(self.wakeup_r, selectors.EVENT_READ)
 
-                    # Response
-                    response = util.package(t[0], self.STATUS_MESSAGES[t[0]], t[1])
-                    conn.send(response)
+            while self.system_on:
+                self.poll()
 
-        # Connection to client is terminated    
-        except app.ConnectionError:
-            with self.lock:
-                if self.main_window.is_alive():
-                    self.main_window.f_stat.dec_activeconnections()
-                    if self.current_thread_has_user_logged_in():
-                        self.main_window.f_stat.dec_activeusers()
+            # Stop accepting, and keep serving the connections until they are closed
+            self.selector.unregister(self.main_socket)
+            thread_drain = threading.Thread(target=self.drain)
+            thread_drain.start()
+            while thread_drain.is_alive():
+                self.poll(timeout=0.1)
 
-            # Remove the thread
-            self.clients.pop(threading.current_thread().ident)
-        
+        self.pool.shutdown()
 
-    # ---------- Methods handling requests from clients ----------
+    def wake(self):
+        self.wakeup_w.send(b'\0')
 
-    def test(self, command_type, data):
-        return ('000', 'vl' * 1000)
+    # ---------- Methods used by the I/O thread ----------
 
-    def request_discovery(self):
-        """This function listens for remote client discovery message and responses
-        with the server address"""
+    def poll(self, timeout=1.0):
+        """Wait for sockets to be ready, for at most timeout seconds, and handle them
+        """
 
-        # Create the UDP discovery socket
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.bind(('', self.DISCOVERY_PORT))
+        for key, _ in self.selector.select(timeout=timeout):
+            if key.fileobj is self.main_socket:
+                self.accept()
+            elif key.fileobj is self.wakeup_r:
+                self.wakeup_r.recv(4096)
+                self.resume_connections()
+                self.accept_admitted_clients()
+            elif key.data is None:
+                self.read_connect_request(key.fileobj)
+            else:
+                self.read_requests(key.data)
+        self.expire_handshakes()
+
+    def accept(self):
+        """Accept the pending connections, and wait for their connect request
+        """
 
         while True:
-            # Listen for requests
-            message, client_connection = s.recvfrom(1024)
-            # util.print_message(message)
+            try:
+                conn, _ = self.main_socket.accept()
+            except BlockingIOError:
+                return
+
+            # Sockets are only read when they are readable, but written to by blocking calls
+            conn.setblocking(True)
+            self.handshakes[conn] = (self.create_reader(conn), time.monotonic() + 1.0)
+            self.selector.register(conn, selectors.EVENT_READ)
+
+    def expire_handshakes(self):
+        """Close the connections that did not send their connect request in time, and reject the
+        clients that waited too long for their admission
+        """
 
-            # Verify the discovery message
-            command, *_ = util.extract(message)
-            if command == 'discover':
-                s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-                s.sendto(
-                    util.package('000', '', self.SERVER_ADDRESS),
-                    ('255.255.255.255', client_connection[1])
-                )
+        now = time.monotonic()
+        for conn in [c for c, (_, deadline) in self.handshakes.items() if deadline < now]:
+            del self.handshakes[conn]
+            self.selector.unregister(conn)
+            conn.close()
 
-    def request_connect(self, conn: socket.socket):
-        """Verify connection request from clients. In particular, approve or reject the
-        client connection based on the number of clients currently serving.
+        for conn in [c for c, (*_, deadline) in self.admitting.items() if deadline < now]:
+            _, _, ticket, _ = self.admitting[conn]
+            if not self.admission.withdraw(ticket):
+                # Admitted in the meantime, see accept_admitted_clients
+                continue
+            del self.admitting[conn]
+            self.reject_client(conn)
+
+    def read_connect_request(self, conn: socket.socket):
+        """Same as Server.request_connect, once the socket is readable
 
         Parameters
         ----------
         conn : socket.socket
-            The newly created connection to the client
 
-        Returns
-        -------
-        bool
-            True if the connection is approved. Otherwise, close the connection and
-            return False.
         """
 
-        # Setting limited time for the client to send connect request
-        conn.settimeout(1.0)
-
+        reader, _ = self.handshakes[conn]
         try:
-            # Verify the connect message
-            command, *_ = util.extract(self.receive_from(conn))
+            reader.fill()
+            m = reader.next_frame()
+            if m is None:
+                return
+            del self.handshakes[conn]
+            self.selector.unregister(conn)
+
+            command, _, _, data = util.extract(m)
             if command != 'connect':
-                conn.close()
                 raise app.ConnectionError('Not a connect request')
+            connection = app.Connection(conn, reader)
+            accepted = self.negotiate(connection, data)
 
-            # Reset the timeout for future use
-            conn.settimeout(None)
-            with self.lock:
-                # There is enough space for the client
-                if len(self.clients) < self.MAX_CLIENT_THREADS:
-                    conn.send(util.package('000', self.STATUS_MESSAGES['000'], ''))
-                    return True
-                else:
-                    conn.send(util.package('001', self.STATUS_MESSAGES['001'], ''))
-                    raise app.ConnectionError('Max client reached')
-
-        # Catch any exception, including socket.timeout
+        # Catch any exception, including socket errors
         except Exception:
+            if self.handshakes.pop(conn, None) is not None:
+                self.selector.unregister(conn)
             conn.close()
-            return False
+            return
 
-    def request_login(self, command_type, request_data):
-        """Handle the login command
+        ticket = self.admission.enter()
+        if ticket is None:
+            self.reject_client(conn)
+        elif ticket.done():
+            self.accept_client(connection, accepted, ticket)
+        else:
+            # Wait for enough space for the client, without holding up the other connections
+            self.admitting[conn] = (connection, accepted, ticket, time.monotonic() + self.ADMISSION_MAX_WAIT)
+            ticket.add_done_callback(lambda _: self.notify_admission(conn))
+
+    def accept_client(self, connection: app.Connection, accepted, ticket):
+        """Complete the connect handshake of an admitted client, and start reading its requests
 
         Parameters
         ----------
-        command_type : str
-            
-        data : str
-        
-        Returns
-        -------
-        tuple
-            A tuple of (status_code, response_data)
+        connection : app.Connection
+
+        accepted : dict
+            The accepted features (see negotiate)
+        ticket : concurrent.futures.Future
+            The admission ticket of the client
         """
 
-        status_code = ''
-        response_data = ''
+        try:
+            connection.sock.sendall(util.package('000', self.STATUS_MESSAGES['000'], util.format_features(accepted)))
+        except OSError:
+            self.admission.leave(ticket)
+            connection.sock.close()
+            return
+        self.register_client(connection, ticket)
 
-        username, password = request_data.split(',', 1)
-        if self.logged_in(username):
-            return ('101', '')
+        self.statistics.count_connections(1)
+        self.selector.register(connection.sock, selectors.EVENT_READ, connection)
 
-        with database.Database(self.DATABASE_PATH) as db:
-            admin = False
-            if command_type == 'admin':
-                admin = True
-                if len(username) != 3 or not username.isnumeric():
-                    return ('104', '')
+        # The client may have sent requests right after the connect request
+        self.process_requests(connection)
 
-            user_info = db.authenticate(username, password)
+    def reject_client(self, conn: socket.socket):
+        """Reject a client that could not be admitted, and close its connection
 
-            if len(user_info) == 1:
-                # Record user login time
-                self.clients[threading.current_thread().ident] = (
-                    username,
-                    'admin' if admin else 'ordinary',
-                    datetime.datetime.now()
-                )
+        Parameters
+        ----------
+        conn : socket.socket
 
-                # Increase active users
-                if self.main_window.is_alive():
-                    self.main_window.f_stat.inc_activeusers()
-                
-                response_data = f'{username},{user_info[0][1]}\n'                
-                status_code = '000'
+        """
+
+        try:
+            conn.sendall(self.reject_response())
+        except OSError:
+            pass
+        conn.close()
+
+    def accept_admitted_clients(self):
+        """Complete the connect handshake of the waiting clients that have been admitted
+        """
+
+        while True:
+            try:
+                conn = self.admitted.get_nowait()
+            except queue.Empty:
+                return
+            connection, accepted, ticket, _ = self.admitting.pop(conn)
+            if ticket.result():
+                self.accept_client(connection, accepted, ticket)
             else:
-                status_code = '100'
-        return (status_code, response_data)
+                self.reject_client(conn)
 
-    def request_signup(self, command_type, request_data):
-        """Handle the signup command
+    def read_requests(self, connection: app.Connection):
+        """Receive data from a readable connection, and process the requests
 
         Parameters
         ----------
-        command_type : str
-            
-        request_data : str
-            
+        connection : app.Connection
 
-        Returns
-        -------
-        tuple
-            A tuple of (status_code, response_data)
         """
 
-        name, username, password = request_data.split(',', 2)
-        with database.Database(self.DATABASE_PATH) as db:
-            response_data = db.sign_up(username, password, name)
-            if response_data:
-                return ('000', '')
-            return ('102', '')
+        try:
+            connection.reader.fill()
+        except app.ConnectionError:
+            self.close_connection(connection)
+            return
+        self.process_requests(connection)
 
-    def request_logout(self, command_type, request_data):
-        """Handle the logout command
+    def process_requests(self, connection: app.Connection):
+        """Hand the requests fully received on a connection to the workers. Stops at the first
+        request to execute in order, until it is done (see resume_connections).
 
         Parameters
         ----------
-        command_type : str
-            
-        request_data : str
-            
+        connection : app.Connection
 
-        Returns
-        -------
-        tuple
-            A tuple of (status_code, response_data)
         """
 
-        # User is not currently logged in
-        if not self.current_thread_has_user_logged_in():
-            return ('103', '')
-        else:
-            # Remove the user info associated with the thread
-            self.clients[threading.current_thread().ident] = ('', '', '')
-            
-            # Decrease active users
-            if self.main_window.is_alive():
-                self.main_window.f_stat.dec_activeusers()
-            return ('000', '')
+        current_connection.set(connection)
+        try:
+            while True:
+                m = connection.reader.next_frame()
+                if m is None:
+                    return
+                command, command_type, data, request_id, flags = connection.parse(m)
+
+                # Update the request statistics
+                self.update_request_statistics(connection.sock, command)
+
+                client = self.clients.begin_request(connection)
+                if client is None:
+                    # Let go: the server is shutting down
+                    continue
 
-    def request_query(self, command_type, request_data):
-        """Handle the query command
+                # Pipelined requests are answered out of order, as soon as they are done
+                if request_id is not None and command in self.PIPELINED_COMMANDS:
+                    self.pool.submit(
+                        self.do_pipelined_request, client, command, command_type, data, request_id, flags
+                    )
+                    continue
+
+                self.selector.unregister(connection.sock)
+                self.pool.submit(
+                    self.do_request_in_order, client, command, command_type, data, request_id, flags
+                )
+                return
+
+        # Connection to client is terminated
+        except (app.ConnectionError, OSError):
+            self.close_connection(connection)
+
+    def resume_connections(self):
+        """Read again the connections whose request is done
+        """
+
+        while True:
+            try:
+                connection = self.done.get_nowait()
+            except queue.Empty:
+                return
+            self.selector.register(connection.sock, selectors.EVENT_READ, connection)
+            self.process_requests(connection)
+
+    def close_connection(self, connection: app.Connection):
+        """Close a terminated connection and forget its client
 
         Parameters
         ----------
-        command_type : str
-            
-        request_data : str
-            
+        connection : app.Connection
 
-        Returns
-        -------
-        tuple
-            A tuple of (status_code, response_data)
         """
 
-        status_code = ''
-        response_data = ''
-        with database.Database(self.DATABASE_PATH) as db:
-            if command_type == 'city':
-                # data contains the keyword to search
-                r = db.search_city(request_data)
-                num_city = len(r)
+        self.selector.unregister(connection.sock)
+        connection.sock.close()
+        current_connection.set(connection)
+        self.remove_client()
 
-                response_data = str(num_city) + '\n'
-                for city in r:
-                    response_data += ','.join([str(x) for x in city]) + '\n'
-                status_code = '000'
-            
-            elif command_type == 'weather':
-                # data contains the date in YYYY-MM-DD format
-                r = db.query_weather_by_date(request_data)
-                num_city = len(r)
-
-                response_data = str(num_city) + '\n'
-                for city in r:
-                    response_data += ','.join([str(x) for x in city]) + '\n'
-                status_code = '000'
-            
-            elif command_type == 'forecast':
-                # data contains the city id
-                r = db.forecast(int(request_data))
-                num_result = len(r)
-
-                response_data = str(num_result) + '\n'
-                for entry in r:
-                    response_data += ','.join([str(x) for x in entry]) + '\n'
-                status_code = '000'
-        
-        return (status_code, response_data)
+    # ---------- Methods used by the workers ----------
 
-    def request_update(self, command_type, request_data):
-        """Handle the update command
+    def notify_admission(self, conn: socket.socket):
+        """Called when a waiting client is admitted (by the thread of the client that left) or
+        refused
+        """
 
-        Parameters
-        ----------
-        command_type : str
-            
-        request_data : str
-            
+        self.admitted.put(conn)
+        self.wakeup_w.send(b'\0')
 
-        Returns
-        -------
-        tuple
-            A tuple of (status_code, response_data)
+    def do_request_in_order(self, *args):
+        """Target function for the workers executing requests in order. Same parameters as
+        do_request.
         """
 
-        # Check user's priviledge
-        if self.clients[threading.current_thread().ident][1] != 'admin':
-            return ('300', '')
+        try:
+            self.do_request(*args)
+        except app.ConnectionError:
+            # Noticed when the connection is read again
+            pass
+        except Exception:
+            self.fail_request(args[0].connection)
+        finally:
+            self.done.put(args[0].connection)
+            self.wakeup_w.send(b'\0')
+
+# Server classes, by engine name
+ENGINES = {
+    'threads': Server,
+    'asyncio': AsyncServer,
+    'pool': PoolServer,
+}
+
+def run_worker(engine, settings, events, stop, logins):
+    """Target function of the worker processes of the multi-process mode
+
+    Parameters
+    ----------
+    engine : str
+        Key of ENGINES
+    settings : dict
+        Attributes to set on the server (e.g. POOL_WORKERS)
+    events : multiprocessing.Queue
+        Queue to send the main window updates to the parent process
+    stop : multiprocessing.Event
+        Set by the parent process when the server is closed
+    logins : LoginTable
+        The users logged in and the sessions, shared by all the processes
+    """
+
+    s = ENGINES[engine](events=events, logins=logins)
+    for name, value in settings.items():
+        setattr(s, name, value)
+
+    def wait_for_stop():
+        stop.wait()
+        s.stop()
+
+    threading.Thread(target=wait_for_stop, daemon=True).start()
+    s.run()
 
-        status_code = ''
-        response_data = ''
-        with self.lock:
-            with database.Database(self.DATABASE_PATH) as db:
-                if command_type == 'city':
-                    s = request_data.split(',', 4)
-                    s[3] = float(s[3])
-                    s[4] = float(s[4])
-                    s = tuple(s)
-                    status_code = '000' if db.add_city(s) else '301'
-                elif command_type == 'weather':
-                    city_id, date, rest = request_data.split(',', 2)
-                    status_code = '000' if db.update_weather(city_id, date, tuple(rest.split(','))) else '302'
+def serve(engine, settings, workers=1):
+    """Run the server, in several processes sharing the same port if workers > 1. The parent
+    process serves clients too, and owns the main window and the discovery thread. The other
+    processes have their own database connections, and send their statistics to the parent. The
+    users logged in and the sessions are shared by all the processes (see LoginTable), while each
+    process admits up to MAX_CLIENT_THREADS clients of its own.
+
+    Parameters
+    ----------
+    engine : str
+        Key of ENGINES
+    settings : dict
+        Attributes to set on the servers (e.g. POOL_WORKERS)
+    workers : int
+        Number of processes
+    """
+
+    context = multiprocessing.get_context('spawn')
+    logins = LoginTable(context.Manager()) if workers > 1 else None
+
+    s = ENGINES[engine](reuse_port=workers > 1, logins=logins)
+    for name, value in settings.items():
+        setattr(s, name, value)
+
+    processes = []
+    if workers > 1:
+        # Upgrade the schema once, rather than have all the processes wait for each other
+        with database.Database(s.DATABASE_PATH) as db:
+            db.migrate()
+
+        events = context.Queue()
+        stop = context.Event()
+        for _ in range(workers - 1):
+            p = context.Process(
+                target=run_worker, args=(engine, settings, events, stop, logins), daemon=True
+            )
+            p.start()
+            processes.append(p)
+            threading.Thread(target=s.forget_worker, args=(p,), daemon=True).start()
+        threading.Thread(target=s.apply_worker_events, args=(events,), daemon=True).start()
+
+        # The workers drain their connections at the same time as the parent process
+        def stop_workers():
+            s.stopped.wait()
+            stop.set()
+
+        threading.Thread(target=stop_workers, daemon=True).start()
 
-        return (status_code, response_data)
+    s.run()
+
+    for p in processes:
+        p.join(timeout=s.SHUTDOWN_DEADLINE + 2.0)
 
 if __name__ == '__main__':
-    s = Server()
-    s.run()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--engine', choices=tuple(ENGINES), default='threads',
+        help='serve each client in its own thread, all of them in an asyncio event loop, or read '
+             'all of them from one thread and execute their requests in a pool of workers'
+    )
+    parser.add_argument('--pool-workers', type=int, help='number of workers (pool engine)')
+    parser.add_argument('--queue-depth', type=int, help='number of requests waiting for a worker (pool engine)')
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='number of server processes sharing the port (requires SO_REUSEPORT)'
+    )
+    args = parser.parse_args()
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error('--workers requires SO_REUSEPORT, which this platform does not support')
+
+    settings = {}
+    if args.pool_workers:
+        settings['POOL_WORKERS'] = args.pool_workers
+    if args.queue_depth:
+        settings['POOL_QUEUE_DEPTH'] = args.queue_depth
+    serve(args.engine, settings, args.workers)
@@ -0,0 +1,162 @@
+"""Fixtures starting a real server on a local port, with a fresh database, and connecting clients to
+it over sockets
+"""
+
+import datetime
+import pathlib
+import queue
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+import pytest
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import app
+import server
+import util
+
+def create_database(path, cities=20):
+    """Create a database with two users (alice, and the admin 123, both with password pw), two
+    countries, and the given number of cities with their weather for the next days
+    """
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(path)
+    con.executescript((ROOT / 'db' / 'database_create_script.sql').read_text())
+    con.execute("INSERT INTO user VALUES ('alice', 'pw', 'Alice')")
+    con.execute("INSERT INTO user VALUES ('123', 'pw', 'Admin')")
+    con.execute("INSERT INTO country VALUES ('VN', 'Viet Nam')")
+    con.execute("INSERT INTO country VALUES ('BR', 'Brazil')")
+    con.execute("INSERT INTO weather_condition VALUES (800, 'Clear', NULL, NULL)")
+    today = datetime.date.today()
+    for i in range(1, cities + 1):
+        con.execute("INSERT INTO city VALUES (?, ?, ?, 1.0, 2.0)", (i, f'City {i}', 'VN' if i % 2 else 'BR'))
+        for d in range(7):
+            date = (today + datetime.timedelta(d)).isoformat()
+            con.execute("INSERT INTO city_weather VALUES (?, ?, '800', 20.5, 30.25, 0.5)", (i, date))
+    con.commit()
+    con.close()
+
+def legacy_package(field1, field2, data) -> bytes:
+    """Build a text message the way older clients did, declaring one byte too few when adding the
+    digits of the size carries over to one more digit (see util.legacy_message_length)
+    """
+
+    header = f'{field1} {field2}\n\n'.encode()
+    data = data.encode()
+    s = len(header) + len(data)
+    return header + str(s + len(str(s)) + 1).encode() + b'\n' + data
+
+def send_split(sock, message, at, pause=0.2):
+    """Send a message in two TCP segments, the second one starting at the given offset
+    """
+
+    sock.sendall(message[:at])
+    time.sleep(pause)
+    sock.sendall(message[at:])
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for(condition, timeout=5.0) -> bool:
+    """Wait for a condition to become true, for at most timeout seconds
+    """
+
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+def open_socket(port) -> socket.socket:
+    """Open a connection to the server, once it is listening
+    """
+
+    deadline = time.monotonic() + 5.0
+    while True:
+        try:
+            return socket.create_connection(('127.0.0.1', port), timeout=10.0)
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.02)
+
+def connect(port, features='') -> app.Connection:
+    """Connect to the server and do the connect handshake as a current client (sending its protocol
+    version), asking for the given features
+
+    Returns
+    -------
+    app.Connection
+        In binary framing if the server accepted it
+    """
+
+    sock = open_socket(port)
+    requested = util.parse_features(features)
+    requested['version'] = str(util.PROTOCOL_VERSION)
+    sock.sendall(util.package('connect', '', util.format_features(requested)))
+    connection = app.Connection(sock, app.FrameReader(sock))
+    status_code, _, data, _, _ = connection.receive()
+    assert status_code == '000'
+    connection.features = util.parse_features(data)
+    if 'binary' in connection.features:
+        connection.reader.framing = 'binary'
+    return connection
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """Path of a fresh database, at the default location of the server (db/weather.db) relative to
+    the working directory
+    """
+
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / 'db' / 'weather.db'
+    create_database(path)
+    return path
+
+@pytest.fixture
+def start_server(database, monkeypatch):
+    """Factory starting a server of the given engine (see server.ENGINES) with the given settings,
+    as a worker process of the multi-process mode would be (without the main window). The servers
+    are stopped at the end of the test.
+    """
+
+    port = free_port()
+    init = app.App.__init__
+
+    def listen_locally(self):
+        init(self)
+        self.SERVER_PORT = port
+        self.DISCOVERY_PORT = 0
+
+    monkeypatch.setattr(app.App, '__init__', listen_locally)
+    monkeypatch.setattr(server, 'get_ip_address', lambda: '127.0.0.1')
+
+    started = []
+
+    def start(engine='threads', **settings):
+        s = server.ENGINES[engine](events=queue.Queue())
+        s.RATE_LIMITS = {}
+        for name, value in settings.items():
+            setattr(s, name, value)
+        thread = threading.Thread(target=s.run, daemon=True)
+        thread.start()
+        started.append((s, thread))
+        return s
+
+    start.port = port
+    yield start
+
+    for s, thread in started:
+        s.stop()
+        thread.join(s.SHUTDOWN_DEADLINE + 2.0)
+
+ENGINES = pytest.mark.parametrize('engine', list(server.ENGINES))
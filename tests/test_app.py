@@ -0,0 +1,66 @@
+import asyncio
+import socket
+import threading
+
+import pytest
+
+from conftest import legacy_package, send_split
+
+import app
+import util
+
+# Data lengths around the sizes that older clients declared one byte too few: 10**n to 10**n + n
+LEGACY_LENGTHS = [4, 5, 84, 85, 86, 87, 88, 985, 986, 987, 988, 989, 9984, 9988, 9989]
+
+@pytest.fixture
+def socket_pair():
+    a, b = socket.socketpair()
+    yield a, b
+    a.close()
+    b.close()
+
+def read_split(socket_pair, messages, legacy_sizes):
+    """Send messages, each one split right before its last byte, and read them back
+    """
+
+    a, b = socket_pair
+    reader = app.FrameReader(b)
+    reader.legacy_sizes = legacy_sizes
+    sender = threading.Thread(target=lambda: [send_split(a, m, len(m) - 1, 0.05) for m in messages])
+    sender.start()
+    try:
+        return [util.extract(reader.read()) for _ in messages]
+    finally:
+        sender.join()
+
+@pytest.mark.parametrize('n', LEGACY_LENGTHS)
+def test_legacy_sizes_split_at_last_byte(socket_pair, n):
+    data = 'x' * (n - 1) + 'y'
+    received = read_split(socket_pair, [legacy_package('query', 'city', data), legacy_package('ping', '', 'z')], True)
+    assert [m[3] for m in received] == [data, 'z']
+
+@pytest.mark.parametrize('n', LEGACY_LENGTHS)
+def test_current_sizes_split_at_last_byte(socket_pair, n):
+    data = 'x' * (n - 1) + 'y'
+    received = read_split(socket_pair, [util.package('query', 'city', data), util.package('ping', '', 'z')], False)
+    assert [m[3] for m in received] == [data, 'z']
+
+def test_legacy_message_length():
+    for size in [10, 11, 100, 101, 102, 1000, 1003, 10000, 10004]:
+        assert util.legacy_message_length(size) == size + 1
+    for size in [9, 12, 99, 103, 999, 1004, 10005]:
+        assert util.legacy_message_length(size) == size
+
+def test_async_connection_sends_from_any_thread(socket_pair):
+    a, b = socket_pair
+
+    async def send_both():
+        stream_reader, stream_writer = await asyncio.open_connection(sock=a)
+        connection = app.AsyncConnection(app.AsyncFrameReader(stream_reader), stream_writer)
+        connection.send('000', 'OK', 'loop')
+        await asyncio.to_thread(connection.send, '000', 'OK', 'thread')
+        await stream_writer.drain()
+
+    asyncio.run(asyncio.wait_for(send_both(), 5.0))
+    reader = app.FrameReader(b)
+    assert [util.extract(reader.read())[3] for _ in range(2)] == ['loop', 'thread']
@@ -0,0 +1,157 @@
+import datetime
+import sqlite3
+import time
+
+import pytest
+
+from conftest import ENGINES, connect, legacy_package, open_socket, send_split, wait_for
+
+import app
+import util
+
+# ---------- Logged-in users ----------
+
+@ENGINES
+def test_user_counted_out_when_connection_dropped(start_server, engine):
+    s = start_server(engine)
+    connection = connect(start_server.port)
+    connection.send('login', '', 'alice,pw')
+    assert connection.receive()[0] == '000'
+    assert s.statistics.collect()[0]['activeusers'] == 1
+
+    # Disconnect without logging out
+    connection.sock.close()
+    assert wait_for(lambda: s.statistics.collect()[0]['activeconnections'] == 0)
+    assert s.statistics.collect()[0]['activeusers'] == 0
+    assert not s.clients.logged_in('alice')
+
+# ---------- Shutdown ----------
+
+def test_shutdown_answers_queued_request(start_server, database):
+    # A single worker, kept busy by an update waiting for the database, locked from outside
+    s = start_server('pool', POOL_WORKERS=1)
+    admin = connect(start_server.port)
+    admin.send('login', 'admin', '123,pw')
+    assert admin.receive()[0] == '000'
+    client = connect(start_server.port)
+
+    lock = sqlite3.connect(database, isolation_level=None)
+    lock.execute('BEGIN IMMEDIATE')
+    # The login is answered a moment before it stops counting
+    in_flight = lambda: sum(c.requests for c in list(s.clients.by_connection.values()))
+    assert wait_for(lambda: in_flight() == 0)
+    admin.send('update', 'weather', f'1,{datetime.date.today().isoformat()},800,1.0,2.0,0.5')
+    assert wait_for(lambda: in_flight() == 1)
+
+    # The query is read, and waits for the worker
+    client.send('query', 'forecast', '1')
+    assert wait_for(lambda: in_flight() == 2)
+    s.stop()
+    time.sleep(0.3)
+    lock.execute('COMMIT')
+
+    assert admin.receive()[0] == '000'
+    assert admin.receive()[0] == 'goaway'
+    assert client.receive()[0] == '000'
+    assert client.receive()[0] == 'goaway'
+
+@ENGINES
+def test_shutdown_lets_idle_client_go(start_server, engine):
+    s = start_server(engine)
+    connection = connect(start_server.port)
+    assert wait_for(lambda: s.statistics.collect()[0]['activeconnections'] == 1)
+
+    # The client does not read, nor close its side, until after the server is closed
+    start = time.monotonic()
+    s.stop()
+    assert s.clients.wait_until_empty(s.SHUTDOWN_DEADLINE)
+    assert time.monotonic() - start < s.SHUTDOWN_DEADLINE / 2
+
+    assert connection.receive()[0] == 'goaway'
+    connection.sock.close()
+
+# ---------- Weather ----------
+
+@pytest.mark.parametrize('features', ['binary,binrows', 'binary,binrows,stream'])
+def test_malformed_stored_date_fails_query(start_server, database, features):
+    # Dates are packed as day numbers in binary rows
+    with sqlite3.connect(database) as con:
+        con.execute(
+            "UPDATE city_weather SET report_date = report_date || 'x' "
+            "WHERE city_id = 1 AND report_date = ?",
+            (datetime.date.today().isoformat(),)
+        )
+    start_server()
+    connection = connect(start_server.port, features)
+    connection.send('login', '', 'alice,pw')
+    assert connection.receive()[0] == '000'
+
+    connection.send('query', 'forecast', '1', flags=util.FLAG_BINARY_ROWS)
+    responses = [connection.receive()]
+    while responses[-1][4] & util.FLAG_MORE:
+        responses.append(connection.receive())
+    assert responses[-1][0] == '002'
+
+    # The connection is still served
+    connection.send('ping', '', 'z')
+    assert connection.receive()[2] == 'z'
+
+@pytest.mark.parametrize('date', ['2024-1-31', '20240131', '2024-02-30', ''])
+def test_update_weather_rejects_malformed_date(start_server, database, date):
+    start_server()
+    admin = connect(start_server.port)
+    admin.send('login', 'admin', '123,pw')
+    assert admin.receive()[0] == '000'
+
+    admin.send('update', 'weather', f'1,{date},800,1.0,2.0,0.5')
+    assert admin.receive()[0] == '302'
+    with sqlite3.connect(database) as con:
+        assert con.execute('SELECT count(*) FROM city_weather WHERE city_id = 1').fetchone() == (7,)
+
+# ---------- Older clients ----------
+
+@ENGINES
+def test_legacy_client_split_at_last_byte(start_server, database, engine):
+    # A password making the login message 101 bytes long, declared as 100 by older clients
+    password = 'p' * 85
+    with sqlite3.connect(database) as con:
+        con.execute("INSERT INTO user VALUES ('bob', ?, 'Bob')", (password,))
+    start_server(engine)
+
+    # Older clients connect without asking for any feature, and use the text framing
+    sock = open_socket(start_server.port)
+    reader = app.FrameReader(sock)
+    sock.sendall(legacy_package('connect', '', ''))
+    assert util.extract(reader.read())[0] == '000'
+
+    login = legacy_package('login', '', f'bob,{password}')
+    assert util.message_length(login) == len(login) - 1
+    send_split(sock, login, len(login) - 1)
+    assert util.extract(reader.read())[:2] == ('000', 'OK')
+
+    sock.sendall(legacy_package('ping', '', 'z'))
+    assert util.extract(reader.read())[3] == 'z'
+    sock.close()
+
+# ---------- Autocompletion index ----------
+
+def test_city_index_reloaded_only_for_other_processes(start_server, database):
+    s = start_server()
+    admin = connect(start_server.port)
+    admin.send('login', 'admin', '123,pw')
+    assert admin.receive()[0] == '000'
+
+    # A city added by this process is put in the index, which is not rebuilt
+    admin.send('update', 'city', '100,Newcity,VN,1.0,2.0')
+    assert admin.receive()[0] == '000'
+    index = s.city_index
+    s.reload_city_index()
+    assert s.city_index is index
+    assert [c[1] for c in index.complete('newcity', 5)] == ['Newcity']
+
+    # A city added by another process is found once the index is reloaded
+    with sqlite3.connect(database) as con:
+        con.execute("INSERT INTO city VALUES (101, 'Newcity Two', 'BR', 1.0, 2.0)")
+    s.reload_city_index()
+    assert s.city_index is not index
+    assert [c[1] for c in s.city_index.complete('newcity', 5)] == ['Newcity', 'Newcity Two']
@@ -1,5 +1,48 @@
+import base64
 import datetime
 import sqlite3
+import struct
+import zlib
+
+# ---------- Binary framing ----------
+
+# Fixed-width header of binary frames: magic, version, flags, command/status code,
+# size of the label (command type or status message), and size of the rest of the frame
+FRAME_MAGIC = b'WP'
+FRAME_VERSION = 1
+
+# Version of the protocol, exchanged during the connect handshake (clients that do not send one
+# are at version 0). Both sides then speak the lowest of their versions.
+PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct('!2sBBHBI')
+
+# Frame flags
+FLAG_RESPONSE = 0x01
+FLAG_REQUEST_ID = 0x02
+FLAG_COMPRESSED = 0x04
+FLAG_MORE = 0x08
+FLAG_BINARY_ROWS = 0x10
+
+# Optional request ID following the header (when FLAG_REQUEST_ID is set), used to match
+# pipelined requests with their responses
+REQUEST_ID = struct.Struct('!I')
+
+# Numeric codes of the commands in binary frames
+COMMAND_CODES = {
+    'connect': 1,
+    'discover': 2,
+    'login': 3,
+    'signup': 4,
+    'logout': 5,
+    'query': 6,
+    'update': 7,
+    'test': 8,
+    'batch': 9,
+    'resume': 10,
+    'goaway': 11,
+    'ping': 12
+}
+COMMAND_NAMES = {v: k for k, v in COMMAND_CODES.items()}
 
 def extract(message: bytes) -> tuple:
     m = message.decode('utf-8')
@@ -14,12 +57,516 @@ def package(field1: str, field2: str, data: str) -> bytes:
     blank_line = '\n\n'.encode()
     data = data.encode()
 
-    s = len(header_line) + len(blank_line) + len(data)
-    message_size = s + len(str(s).encode()) + 1
+    # The message size includes its own digits, so adding them may carry over to one more digit
+    s = len(header_line) + len(blank_line) + len(data) + 1
+    message_size = s + len(str(s))
+    if len(str(message_size)) != len(str(s)):
+        message_size += 1
 
     message = header_line + blank_line + str(message_size).encode() + '\n'.encode() + data
     return message
 
+def message_length(buffer, start=0, end=None) -> int:
+    """Read the size of the text message starting at buffer[start], without decoding it
+
+    Parameters
+    ----------
+    buffer : bytes or bytearray
+    start : int
+    end : int
+        End of the valid data in buffer, defaults to len(buffer)
+
+    Returns
+    -------
+    int
+        The message size, or -1 if the size line has not arrived yet.
+
+    Raises
+    ------
+    ValueError
+        If the size line is malformed.
+    """
+
+    end = len(buffer) if end is None else end
+    blank = buffer.find(b'\n\n', start, end)
+    if blank == -1:
+        return -1
+    newline = buffer.find(b'\n', blank + 2, end)
+    if newline == -1:
+        return -1
+    return int(buffer[blank + 2:newline])
+
+def legacy_message_length(size) -> int:
+    """The actual size of a text message sent by an older client, given its declared size. Their
+    size formula left out one byte when adding the digits of the size carried over to one more
+    digit: they declared 10**n to 10**n + n for messages one byte longer, and never declared these
+    sizes otherwise.
+
+    Parameters
+    ----------
+    size : int
+        The size declared by the message (see message_length)
+
+    Returns
+    -------
+    int
+        The size of the message.
+    """
+
+    digits = len(str(size))
+    if 10 <= size < 10 ** (digits - 1) + digits:
+        return size + 1
+    return size
+
+class Compression:
+    """Per-connection zlib streaming contexts. Every compressed frame is flushed on its own, but the
+    compression history is kept from one frame to the next, so repetitive data (city and country
+    names) compresses better and better. Frames must therefore be decompressed in the order they
+    were compressed.
+    """
+
+    def __init__(self, threshold=1024, dictionary=None, level=6, max_size=None):
+        """
+        Parameters
+        ----------
+        threshold : int
+            Data smaller than this (in bytes) is sent uncompressed
+        dictionary : bytes
+            Optional preset dictionary, must be the same on both sides
+        level : int
+            zlib compression level
+        max_size : int
+            Maximum size of the data of a decompressed frame (in bytes), so that a small frame
+            cannot inflate to any size (zlib bomb). Not limited if None.
+        """
+
+        self.threshold = threshold
+        self.max_size = max_size
+        if dictionary:
+            self.compressor = zlib.compressobj(level, zdict=dictionary)
+            self.decompressor = zlib.decompressobj(zdict=dictionary)
+        else:
+            self.compressor = zlib.compressobj(level)
+            self.decompressor = zlib.decompressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def decompress(self, data) -> bytes:
+        """
+        Raises
+        ------
+        ValueError
+            If the decompressed data is larger than max_size. The context is then unusable, and
+            so is the connection.
+        """
+
+        if self.max_size is None:
+            return self.decompressor.decompress(data)
+        decompressed = self.decompressor.decompress(data, self.max_size)
+        if self.decompressor.unconsumed_tail:
+            raise ValueError('Decompressed frame too large')
+        return decompressed
+
+def dictionary_id(dictionary: bytes) -> str:
+    """Identify a preset compression dictionary (the same way zlib does)
+    """
+
+    return str(zlib.adler32(dictionary))
+
+def parse_features(data: str) -> dict:
+    """Parse a comma-separated list of protocol features, each of them being either <name>
+    or <name>=<value>
+
+    Parameters
+    ----------
+    data : str
+
+    Returns
+    -------
+    dict
+        A dictionary mapping feature names to their values ('' if no value).
+    """
+
+    features = {}
+    for f in data.split(','):
+        if f:
+            name, _, value = f.partition('=')
+            features[name] = value
+    return features
+
+def format_features(features: dict) -> str:
+    """Inverse of parse_features
+    """
+
+    return ','.join(name + '=' + value if value else name for name, value in features.items())
+
+def package_frame(field1: str, field2: str, data: str, request_id=None, compression=None, flags=0) -> bytes:
+    """Build a binary frame. field1 is either a command or a three-digit status code.
+
+    Parameters
+    ----------
+    field1 : str
+        The command (requests) or the status code (responses).
+    field2 : str
+        The command type (requests) or the status message (responses).
+    data : str or bytes
+        bytes for binary rows (see encode_rows)
+    request_id : int
+        Optional ID of the request (responses carry the ID of the request they answer).
+    compression : Compression
+        Compression context of the connection, if compression is enabled on it.
+    flags : int
+        Additional flags, e.g. FLAG_MORE on the chunks of a streamed response.
+
+    Returns
+    -------
+    bytes
+    """
+
+    if field1.isdecimal():
+        flags, code = flags | FLAG_RESPONSE, int(field1)
+    else:
+        code = COMMAND_CODES[field1]
+
+    prefix = b''
+    if request_id is not None:
+        flags |= FLAG_REQUEST_ID
+        prefix = REQUEST_ID.pack(request_id)
+
+    label = field2.encode()
+    if isinstance(data, str):
+        data = data.encode()
+    if compression is not None and len(data) >= compression.threshold:
+        flags |= FLAG_COMPRESSED
+        data = compression.compress(data)
+    body_size = len(prefix) + len(label) + len(data)
+    header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, flags, code, len(label), body_size)
+    return b''.join((header, prefix, label, data))
+
+def frame_length(buffer, start=0, end=None) -> int:
+    """Compute the full length of the binary frame at buffer[start], looking at the header only
+
+    Parameters
+    ----------
+    buffer : bytes-like
+    start : int
+    end : int
+        End of the valid data in buffer, defaults to len(buffer)
+
+    Returns
+    -------
+    int
+        The frame length, or -1 if the header is not complete yet.
+
+    Raises
+    ------
+    ValueError
+        If the buffer does not start with a valid header.
+    """
+
+    end = len(buffer) if end is None else end
+    if end - start < FRAME_HEADER.size:
+        return -1
+    magic, version, _, _, _, body_size = FRAME_HEADER.unpack_from(buffer, start)
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise ValueError('Invalid frame header')
+    return FRAME_HEADER.size + body_size
+
+def extract_frame(message, compression=None) -> tuple:
+    """Parse a binary frame built by package_frame
+
+    Parameters
+    ----------
+    message : bytes-like
+
+    compression : Compression
+        Compression context of the connection, if compression is enabled on it.
+
+    Returns
+    -------
+    tuple
+        A tuple of (field1, field2, message_size, data), the same as extract. data is bytes for
+        responses containing binary rows (FLAG_BINARY_ROWS), str otherwise. On requests, the flag
+        asks for a response in binary rows.
+    """
+
+    size = frame_length(message)
+    if size == -1 or len(message) < size:
+        raise ValueError('Incomplete frame')
+    _, _, flags, code, label_size, _ = FRAME_HEADER.unpack_from(message)
+
+    field1 = f'{code:03d}' if flags & FLAG_RESPONSE else COMMAND_NAMES[code]
+    m = memoryview(message)
+    start = FRAME_HEADER.size
+    if flags & FLAG_REQUEST_ID:
+        start += REQUEST_ID.size
+    field2 = str(m[start:start + label_size], 'utf-8')
+    data = m[start + label_size:size]
+    if flags & FLAG_COMPRESSED:
+        if compression is None:
+            raise ValueError('Unexpected compressed frame')
+        data = compression.decompress(data)
+    if flags & FLAG_BINARY_ROWS and flags & FLAG_RESPONSE:
+        return field1, field2, size, bytes(data)
+    return field1, field2, size, str(data, 'utf-8')
+
+def frame_flags(message) -> int:
+    """Get the flags of a binary frame
+    """
+
+    return FRAME_HEADER.unpack_from(message)[2]
+
+def frame_request_id(message):
+    """Get the request ID of a binary frame
+
+    Parameters
+    ----------
+    message : bytes-like
+
+    Returns
+    -------
+    int
+        The request ID.
+    None
+        If the frame does not carry one.
+    """
+
+    flags = FRAME_HEADER.unpack_from(message)[2]
+    if flags & FLAG_REQUEST_ID:
+        return REQUEST_ID.unpack_from(message, FRAME_HEADER.size)[0]
+    return None
+
+def package_as(framing: str, field1: str, field2: str, data: str, request_id=None, compression=None, flags=0) -> bytes:
+    """Build a message using the given framing mode ('text' or 'binary'). Request IDs, compression
+    and flags are only supported by the binary framing.
+    """
+
+    if framing == 'binary':
+        return package_frame(field1, field2, data, request_id, compression, flags)
+    return package(field1, field2, data)
+
+def format_rows(rows) -> str:
+    """Format rows of a query result as comma-separated lines
+
+    Parameters
+    ----------
+    rows : iterable
+        An iterable of tuples.
+
+    Returns
+    -------
+    str
+    """
+
+    return ''.join([','.join([str(x) for x in row]) + '\n' for row in rows])
+
+def format_result(rows) -> str:
+    """Format a whole query result: a line containing the number of rows (see result_header),
+    followed by the rows (see format_rows)
+
+    Parameters
+    ----------
+    rows : iterable
+
+    Returns
+    -------
+    str
+    """
+
+    consumed = list(rows)
+    return result_header(rows, len(consumed)) + '\n' + format_rows(consumed)
+
+def result_header(rows, num_row) -> str:
+    """The first line of a query result: the number of rows, followed by the continuation token
+    if the result is a Page (<n>,<token>, the token being empty on the last page)
+
+    Parameters
+    ----------
+    rows : iterable
+        The rows, already consumed.
+    num_row : int
+
+    Returns
+    -------
+    str
+    """
+
+    if isinstance(rows, Page):
+        return f'{num_row},{rows.token or ""}'
+    return str(num_row)
+
+def encode_token(key: int) -> str:
+    """Build the opaque continuation token of a page ending with the given key (or of the page
+    starting at the given offset, see Page)
+    """
+
+    return base64.urlsafe_b64encode(f'k{key}'.encode()).decode()
+
+def decode_token(token: str) -> int:
+    """Inverse of encode_token
+
+    Raises
+    ------
+    ValueError
+        If the token is invalid.
+    """
+
+    try:
+        key = base64.urlsafe_b64decode(token.encode()).decode()
+    except Exception:
+        raise ValueError('Invalid token')
+    if not key.startswith('k'):
+        raise ValueError('Invalid token')
+    return int(key[1:])
+
+# ---------- Binary rows ----------
+
+# Binary row blocks start with the number of columns and their types: i (integer), s (string, as an
+# index in the string table of the block), d (date, as a day number) and f (float32)
+ROW_COLUMN_FORMATS = {'i': 'i', 's': 'I', 'd': 'i', 'f': 'f'}
+ROW_COUNT = struct.Struct('!I')
+ROW_STRING_SIZE = struct.Struct('!H')
+
+# Stands for NULL strings and dates
+ROW_NULL = 0xFFFFFFFF
+
+def encode_rows(rows, schema: str) -> bytes:
+    """Encode rows in a compact binary block: the schema, a table of the distinct strings, and
+    the rows packed with fixed-width columns
+
+    Parameters
+    ----------
+    rows : iterable
+        An iterable of tuples.
+    schema : str
+        One character for each column (see ROW_COLUMN_FORMATS), e.g. 'issdsfff'.
+
+    Returns
+    -------
+    bytes
+
+    Raises
+    ------
+    ValueError
+        If a value does not fit its column, e.g. a malformed date.
+    """
+
+    row_struct = struct.Struct('!' + ''.join(ROW_COLUMN_FORMATS[c] for c in schema))
+    strings = {}
+    packed = []
+    for row in rows:
+        values = []
+        for t, x in zip(schema, row):
+            if t == 's':
+                x = ROW_NULL if x is None else strings.setdefault(x, len(strings))
+            elif t == 'd':
+                x = -1 if x is None else datetime.date.fromisoformat(x).toordinal()
+            elif t == 'f':
+                x = float('nan') if x is None else x
+            values.append(x)
+        try:
+            packed.append(row_struct.pack(*values))
+        except struct.error as e:
+            raise ValueError(e)
+
+    parts = [bytes([len(schema)]), schema.encode(), ROW_COUNT.pack(len(strings))]
+    for x in strings:
+        b = x.encode()
+        parts.append(ROW_STRING_SIZE.pack(len(b)))
+        parts.append(b)
+    parts.append(ROW_COUNT.pack(len(packed)))
+    parts.extend(packed)
+    return b''.join(parts)
+
+def decode_rows(data) -> list:
+    """Inverse of encode_rows. Dates are returned in ISO 8601 format, like in text rows.
+
+    Parameters
+    ----------
+    data : bytes-like
+
+    Returns
+    -------
+    list
+        A list of tuples.
+    """
+
+    m = memoryview(data)
+    num_column = m[0]
+    schema = str(m[1:1 + num_column], 'ascii')
+    pos = 1 + num_column
+
+    (num_string,) = ROW_COUNT.unpack_from(m, pos)
+    pos += ROW_COUNT.size
+    strings = []
+    for _ in range(num_string):
+        (size,) = ROW_STRING_SIZE.unpack_from(m, pos)
+        pos += ROW_STRING_SIZE.size
+        strings.append(str(m[pos:pos + size], 'utf-8'))
+        pos += size
+
+    (num_row,) = ROW_COUNT.unpack_from(m, pos)
+    pos += ROW_COUNT.size
+    row_struct = struct.Struct('!' + ''.join(ROW_COLUMN_FORMATS[c] for c in schema))
+    end = pos + num_row * row_struct.size
+
+    rows = []
+    for values in row_struct.iter_unpack(m[pos:end]):
+        row = []
+        for t, x in zip(schema, values):
+            if t == 's':
+                x = None if x == ROW_NULL else strings[x]
+            elif t == 'd':
+                x = None if x == -1 else datetime.date.fromordinal(x).isoformat()
+            elif t == 'f':
+                # Back from float32 to the number as it was written
+                x = None if x != x else float(f'{x:.7g}')
+            row.append(x)
+        rows.append(tuple(row))
+    return rows
+
+class Page:
+    """One page of a query result. The query is expected to fetch one row more than the page size:
+    that row is not returned, but tells that there is a next page. Once the rows are consumed,
+    token is the continuation token of the next page (None on the last page).
+    """
+
+    def __init__(self, rows, size, offset=None):
+        """
+        Parameters
+        ----------
+        rows : iterable
+            At most size + 1 rows, sorted by their first column (the pagination key).
+        size : int
+            The page size
+        offset : int
+            For rows not sorted by key, the number of rows of the previous pages: the token is then
+            the offset of the next page instead of the last key of this one.
+        """
+
+        self.rows = rows
+        self.size = size
+        self.offset = offset
+        self.token = None
+
+    def __iter__(self):
+        last = None
+        for i, row in enumerate(self.rows):
+            if i == self.size:
+                self.token = encode_token(last[0] if self.offset is None else self.offset + i)
+                break
+            last = row
+            yield row
+
+def extract_as(framing: str, message, compression=None) -> tuple:
+    """Parse a message using the given framing mode ('text' or 'binary')
+    """
+
+    if framing == 'binary':
+        return extract_frame(message, compression)
+    return extract(bytes(message))
+
 def print_message(message: bytes):
     print(message.decode('utf-8'))
 
@@ -37,8 +584,8 @@ def validate_iso_date_format(date):
     """
 
     try:
-        datetime.date.fromisoformat(date)
-        return True
+        # fromisoformat also accepts other ISO 8601 formats (20240131, 2024-W05-3)
+        return datetime.date.fromisoformat(date).isoformat() == date
     except Exception:
         return False
     
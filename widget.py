@@ -269,6 +269,9 @@ class Forecast(ttk.Frame):
         # Hold the result of the last city search. A dict mapping from "city_name, country_name" to city_id
         self.recent_cities = {}
 
+        # Keyword and continuation token of the next page of the last city search
+        self.search_page = ('', None)
+
         # Label
         self.l_forecast = ttk.Label(master=self, text='Forecast', **BOLD14)
 
@@ -415,30 +418,70 @@ class Statistics(ttk.Frame):
         self.v_activeconnections = tk.IntVar(value=0)
         self.v_activeusers = tk.IntVar(value=0)
         self.v_requestsmade = tk.IntVar(value=0)
+        self.v_queuewait = tk.StringVar(value='-')
+        self.v_executiontime = tk.StringVar(value='-')
+        self.v_waitingclients = tk.IntVar(value=0)
+        self.v_admissionwait = tk.StringVar(value='-')
+        self.v_indexsize = tk.StringVar(value='-')
 
         self.l_activeconnections = ttk.Label(self, textvariable=self.v_activeconnections, **BOLD12)
         self.l_activeusers = ttk.Label(self, textvariable=self.v_activeusers, **BOLD12)
         self.l_requestsmade = ttk.Label(self, textvariable=self.v_requestsmade, **BOLD12)
+        self.l_queuewait = ttk.Label(self, textvariable=self.v_queuewait, **BOLD12)
+        self.l_executiontime = ttk.Label(self, textvariable=self.v_executiontime, **BOLD12)
+        self.l_waitingclients = ttk.Label(self, textvariable=self.v_waitingclients, **BOLD12)
+        self.l_admissionwait = ttk.Label(self, textvariable=self.v_admissionwait, **BOLD12)
+        self.l_indexsize = ttk.Label(self, textvariable=self.v_indexsize, **BOLD12)
 
         self.display()
 
-    def inc_activeconnections(self):
-        self.v_activeconnections.set(self.v_activeconnections.get() + 1)
+    def show(self, statistics):
+        """Display the statistics collected by the server
+
+        Parameters
+        ----------
+        statistics : dict
+            The values by statistic: 'activeconnections', 'activeusers', 'requestsmade',
+            'waitingclients', 'admissionwait', 'indexsize' (memory used by the autocompletion
+            index, in bytes), and 'queuewait' and 'executiontime' if requests were timed since the
+            last call
+        """
+
+        self.v_activeconnections.set(statistics['activeconnections'])
+        self.v_activeusers.set(statistics['activeusers'])
+        self.v_requestsmade.set(statistics['requestsmade'])
+        if 'queuewait' in statistics:
+            self.set_requesttimes(statistics['queuewait'], statistics['executiontime'])
+        self.set_admission(statistics['waitingclients'], statistics['admissionwait'])
+        self.v_indexsize.set(f"{statistics['indexsize'] / (1024 * 1024):.1f} MiB")
+
+    def set_requesttimes(self, queue_wait, execution_time):
+        """Display the time requests wait for a worker and the time they take to execute
+
+        Parameters
+        ----------
+        queue_wait : float
+            In seconds
+        execution_time : float
+            In seconds
+        """
 
-    def dec_activeconnections(self):
-        self.v_activeconnections.set(self.v_activeconnections.get() - 1)
+        self.v_queuewait.set(f'{queue_wait * 1000:.1f} ms')
+        self.v_executiontime.set(f'{execution_time * 1000:.1f} ms')
 
-    def inc_activeusers(self):
-        self.v_activeusers.set(self.v_activeusers.get() + 1)
+    def set_admission(self, waiting_clients, admission_wait):
+        """Display the number of clients waiting for admission and the time they wait
 
-    def dec_activeusers(self):
-        self.v_activeusers.set(self.v_activeusers.get() - 1)
+        Parameters
+        ----------
+        waiting_clients : int
 
-    def inc_requestsmade(self):
-        self.v_requestsmade.set(self.v_requestsmade.get() + 1)
+        admission_wait : float
+            In seconds
+        """
 
-    def dec_requestsmade(self):
-        self.v_requestsmade.set(self.v_requestsmade.get() - 1)
+        self.v_waitingclients.set(waiting_clients)
+        self.v_admissionwait.set(f'{admission_wait * 1000:.1f} ms')
 
     def display(self):
         for i in range(0, 2):
@@ -450,6 +493,16 @@ class Statistics(ttk.Frame):
         self.l_activeusers.grid(row=3, column=0)
         ttk.Label(self, text='Requests Made').grid(row=2, column=1)
         self.l_requestsmade.grid(row=3, column=1)
+        ttk.Label(self, text='Queue Wait').grid(row=4, column=0)
+        self.l_queuewait.grid(row=5, column=0)
+        ttk.Label(self, text='Execution Time').grid(row=4, column=1)
+        self.l_executiontime.grid(row=5, column=1)
+        ttk.Label(self, text='Waiting Clients').grid(row=6, column=0)
+        self.l_waitingclients.grid(row=7, column=0)
+        ttk.Label(self, text='Admission Wait').grid(row=6, column=1)
+        self.l_admissionwait.grid(row=7, column=1)
+        ttk.Label(self, text='Autocomplete Index').grid(row=8, column=0, columnspan=2)
+        self.l_indexsize.grid(row=9, column=0, columnspan=2)
 
 
 class ServerWindow(threading.Thread):
@@ -457,22 +510,29 @@ class ServerWindow(threading.Thread):
     the multithreaded nature in the Server class)
     """
 
-    def __init__(self, callback):
+    def __init__(self, callback, collect=None):
         """Create the thread
 
         Parameters
         ----------
         callback : function
             Callback function used when exiting the main window
+        collect : function
+            Called a few times per second, returns the statistics to display (see Statistics.show)
+            and the list of new activities (rows of the User Activities table)
         """
         
         super().__init__()
         self.callback = callback
+        self.collect = collect
+
+        # Interval between refreshes of the statistics, in milliseconds
+        self.REFRESH_INTERVAL = 250
 
     def run(self):
         self.root = tk.Tk()
         self.root.title('Server')
-        self.root.geometry('500x300')
+        self.root.geometry('500x400')
         self.root.protocol('WM_DELETE_WINDOW', self.callback)
 
         self.style = Style(theme='lumen')
@@ -486,8 +546,20 @@ class ServerWindow(threading.Thread):
 
         self.f_useractivities.grid(row=0, column=0, sticky='nsew')
         self.f_stat.grid(row=1, column=0, sticky='nsew')
+        if self.collect is not None:
+            self.root.after(self.REFRESH_INTERVAL, self.refresh)
         self.root.mainloop()
 
+    def refresh(self):
+        """Display the statistics and activities collected since the last refresh
+        """
+
+        statistics, activities = self.collect()
+        for row in activities:
+            self.f_useractivities.t_activities.add_row(row)
+        self.f_stat.show(statistics)
+        self.root.after(self.REFRESH_INTERVAL, self.refresh)
+
 if __name__ == '__main__':
     root = tk.Tk()
     c = ConnectToServer(root)